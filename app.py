@@ -1,10 +1,61 @@
 import os
 import datetime
+import glob
+import gzip
+import hashlib
+import heapq
+import hmac
+import http.client
+import io
+import ipaddress
+import json
+import math
+import mimetypes
+import pickle
+import re
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+import zlib
+import click
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from flask import (
-    Flask, flash, render_template, redirect, request, session, url_for)
+    Flask, Response, flash, g, get_flashed_messages, has_request_context,
+    jsonify, render_template, redirect, request, send_file, session,
+    stream_with_context, url_for)
+from flask.sessions import SessionInterface, SessionMixin
 from flask_pymongo import PyMongo
+from bson import json_util
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
+from jinja2 import FileSystemBytecodeCache
+from itsdangerous import BadSignature, Signer, URLSafeSerializer
+from pymongo import (
+    ReplaceOne, ReturnDocument, UpdateOne, monitoring,
+    read_preferences
+)
+from pymongo.errors import (
+    BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure,
+    PyMongoError)
+from werkzeug.datastructures import CallbackDict
 from werkzeug.security import generate_password_hash, check_password_hash
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    # Without Pillow images are linked to directly
+    Image = None
+try:
+    import brotli
+except ImportError:
+    # Without Brotli only gzip is used
+    brotli = None
 if os.path.exists("env.py"):
     import env
 
@@ -15,7 +66,1435 @@ app.config["MONGO_DBNAME"] = os.environ.get("MONGO_DBNAME")
 app.config["MONGO_URI"] = os.environ.get("MONGO_URI")
 app.secret_key = os.environ.get("SECRET_KEY")
 
-mongo = PyMongo(app)
+# Cache Invalidation Constants
+app.config["CACHE_BUS_ENABLED"] = os.environ.get(
+    "CACHE_BUS_ENABLED", "true") == "true"
+app.config["CACHE_BUS_POLL_INTERVAL"] = float(
+    os.environ.get("CACHE_BUS_POLL_INTERVAL", 2))
+
+# Background Job Constants
+# Off means jobs are only run by flask run-jobs
+app.config["JOB_RUNNER_ENABLED"] = os.environ.get(
+    "JOB_RUNNER_ENABLED", "true") == "true"
+app.config["JOB_POLL_INTERVAL"] = float(
+    os.environ.get("JOB_POLL_INTERVAL", 2))
+# A job not renewed for this long is taken over by another worker
+app.config["JOB_LEASE_SECONDS"] = int(
+    os.environ.get("JOB_LEASE_SECONDS", 60))
+app.config["JOB_MAX_ATTEMPTS"] = int(os.environ.get("JOB_MAX_ATTEMPTS", 5))
+# Seconds before the first retry, doubled for each one after
+app.config["JOB_RETRY_DELAY"] = float(os.environ.get("JOB_RETRY_DELAY", 5))
+app.config["JOB_BATCH_SIZE"] = int(os.environ.get("JOB_BATCH_SIZE", 500))
+# Seconds finished jobs are kept for /jobs/<id>
+app.config["JOB_RETENTION"] = int(
+    os.environ.get("JOB_RETENTION", 7 * 24 * 60 * 60))
+
+# Cocktail Cache Constants
+# Number of recipe documents each worker keeps, 0 turns the cache off
+app.config["COCKTAIL_CACHE_SIZE"] = int(
+    os.environ.get("COCKTAIL_CACHE_SIZE", 1000))
+
+# Session Constants
+# memory or sqlite (sqlite can be shared by workers on one machine)
+app.config["SESSION_STORE"] = os.environ.get("SESSION_STORE", "memory")
+app.config["SESSION_SQLITE_PATH"] = os.environ.get(
+    "SESSION_SQLITE_PATH", "sessions.sqlite3")
+app.config["SESSION_IDLE_TIMEOUT"] = int(
+    os.environ.get("SESSION_IDLE_TIMEOUT", 7 * 24 * 60 * 60))
+
+# Duplicate Submit Constants
+# Seconds a form token is remembered for, reloads after this go through
+app.config["IDEMPOTENCY_TTL"] = int(
+    os.environ.get("IDEMPOTENCY_TTL", 24 * 60 * 60))
+app.config["IDEMPOTENCY_MAX_KEYS"] = int(
+    os.environ.get("IDEMPOTENCY_MAX_KEYS", 100000))
+
+# Password Hashing Constants
+# Method includes the pbkdf2 iterations e.g. pbkdf2:sha256:260000
+app.config["PASSWORD_HASH_METHOD"] = os.environ.get(
+    "PASSWORD_HASH_METHOD", "pbkdf2:sha256:150000")
+app.config["PASSWORD_SALT_LENGTH"] = int(
+    os.environ.get("PASSWORD_SALT_LENGTH", 8))
+# 0 hashes on the request thread
+app.config["HASH_POOL_SIZE"] = int(os.environ.get("HASH_POOL_SIZE", 2))
+app.config["HASH_QUEUE_LIMIT"] = int(os.environ.get("HASH_QUEUE_LIMIT", 8))
+app.config["HASH_TIMEOUT"] = float(os.environ.get("HASH_TIMEOUT", 10))
+
+# Mongo Pool Constants
+# Only set options are passed on so pymongo's defaults apply otherwise
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": "MONGO_MAX_POOL_SIZE",
+    "minPoolSize": "MONGO_MIN_POOL_SIZE",
+    "waitQueueTimeoutMS": "MONGO_WAIT_QUEUE_TIMEOUT_MS",
+    "serverSelectionTimeoutMS": "MONGO_SERVER_SELECTION_TIMEOUT_MS",
+    "connectTimeoutMS": "MONGO_CONNECT_TIMEOUT_MS",
+    "socketTimeoutMS": "MONGO_SOCKET_TIMEOUT_MS",
+    "maxIdleTimeMS": "MONGO_MAX_IDLE_TIME_MS",
+}
+for config_name in MONGO_CLIENT_OPTIONS.values():
+    if os.environ.get(config_name):
+        app.config[config_name] = int(os.environ.get(config_name))
+
+# Used by read heavy routes, writes always go to the primary
+# primary, primaryPreferred, secondary, secondaryPreferred or nearest
+app.config["MONGO_READ_PREFERENCE"] = os.environ.get(
+    "MONGO_READ_PREFERENCE", "primary")
+# -1 for no limit, otherwise at least 90 seconds
+app.config["MONGO_MAX_STALENESS_SECONDS"] = int(
+    os.environ.get("MONGO_MAX_STALENESS_SECONDS", -1))
+
+# Trending Constants
+# Scores are stored relative to the epoch so they only ever grow,
+# they are kept as logs so any half life works however old the epoch
+app.config["TRENDING_HALF_LIFE_HOURS"] = float(
+    os.environ.get("TRENDING_HALF_LIFE_HOURS", 168))
+app.config["TRENDING_EPOCH"] = datetime.datetime.strptime(
+    os.environ.get("TRENDING_EPOCH", "2021-01-01"), "%Y-%m-%d")
+
+# List Page Constants
+app.config["STREAM_LIST_PAGES"] = os.environ.get(
+    "STREAM_LIST_PAGES", "true") == "true"
+# Alcohol rails shown on the view all and search pages
+LIST_PAGE_ALCOHOLS = ["vodka", "whiskey", "gin", "rum", "tequila"]
+
+# Image Proxy Constants
+app.config["IMAGE_PROXY_ENABLED"] = os.environ.get(
+    "IMAGE_PROXY_ENABLED", "true") == "true"
+app.config["IMAGE_CACHE_DIR"] = os.environ.get(
+    "IMAGE_CACHE_DIR", "image-cache")
+app.config["IMAGE_CACHE_MAX_BYTES"] = int(
+    os.environ.get("IMAGE_CACHE_MAX_BYTES", 200 * 1024 * 1024))
+app.config["IMAGE_FETCH_TIMEOUT"] = float(
+    os.environ.get("IMAGE_FETCH_TIMEOUT", 10))
+app.config["IMAGE_MAX_SOURCE_BYTES"] = int(
+    os.environ.get("IMAGE_MAX_SOURCE_BYTES", 10 * 1024 * 1024))
+# Only for a local test origin, stops the proxy reaching private networks
+app.config["IMAGE_PROXY_ALLOW_PRIVATE"] = os.environ.get(
+    "IMAGE_PROXY_ALLOW_PRIVATE", "false") == "true"
+# Widths the templates ask for, anything else is refused
+IMAGE_WIDTHS = [320, 640, 1280]
+
+# Static Asset Constants
+# Built by flask build-assets, missing means the plain files are used
+app.config["STATIC_MANIFEST"] = os.environ.get(
+    "STATIC_MANIFEST",
+    os.path.join(app.static_folder, "dist", "manifest.json"))
+# Files in the static folder that are minified and fingerprinted
+STATIC_ASSETS = ["css/*.css", "js/*.js"]
+
+# Compression Constants
+app.config["COMPRESS_ENABLED"] = os.environ.get(
+    "COMPRESS_ENABLED", "true") == "true"
+# Smaller responses aren't worth the CPU
+app.config["COMPRESS_MIN_SIZE"] = int(
+    os.environ.get("COMPRESS_MIN_SIZE", 500))
+app.config["COMPRESS_MIMETYPES"] = os.environ.get(
+    "COMPRESS_MIMETYPES",
+    "text/html,text/css,text/plain,application/json,application/javascript,"
+    "application/x-ndjson,image/svg+xml"
+).split(",")
+# auto picks the level from COMPRESS_CPU_BUDGET_MS, or a fixed level
+app.config["COMPRESS_LEVEL"] = os.environ.get("COMPRESS_LEVEL", "auto")
+app.config["COMPRESS_CPU_BUDGET_MS"] = float(
+    os.environ.get("COMPRESS_CPU_BUDGET_MS", 5))
+
+# Warmup Constants
+# Off means /ready reports ready straight away
+app.config["WARMUP_ENABLED"] = os.environ.get(
+    "WARMUP_ENABLED", "true") == "true"
+# Compiled templates are kept here between restarts
+app.config["TEMPLATE_CACHE_DIR"] = os.environ.get(
+    "TEMPLATE_CACHE_DIR", "template-cache")
+# Seconds the home page rails are kept for between cocktail changes
+app.config["HOME_RAILS_TTL"] = int(os.environ.get("HOME_RAILS_TTL", 60))
+
+# Admission Control Constants
+# Requests each route lets in at once e.g. view_all=4,search=4,profile=8
+app.config["ADMISSION_LIMITS"] = {
+    endpoint: int(limit) for endpoint, limit in (
+        pair.split("=") for pair in os.environ.get(
+            "ADMISSION_LIMITS", "view_all=4,search=4,profile=8").split(",")
+        if pair
+    )
+}
+app.config["ADMISSION_MAX_QUEUE"] = int(
+    os.environ.get("ADMISSION_MAX_QUEUE", 16))
+# How long a request waits for a slot before it is shed
+app.config["ADMISSION_QUEUE_TIMEOUT_MS"] = int(
+    os.environ.get("ADMISSION_QUEUE_TIMEOUT_MS", 2000))
+app.config["ADMISSION_RETRY_AFTER"] = int(
+    os.environ.get("ADMISSION_RETRY_AFTER", 5))
+# Shed requests get the last copy of the page if it is younger than this
+app.config["ADMISSION_STALE_SECONDS"] = int(
+    os.environ.get("ADMISSION_STALE_SECONDS", 600))
+app.config["ADMISSION_STALE_PAGES"] = int(
+    os.environ.get("ADMISSION_STALE_PAGES", 50))
+
+# Metrics Constants
+# If set /metrics needs ?token= or an X-Metrics-Token header
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+
+
+# Mongo Pool Metrics
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Counts connection pool events so the pool can be sized.
+    Wait time is from asking for a connection to getting one.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = threading.local()
+        self.counts = {
+            "open_connections": 0,
+            "checked_out": 0,
+            "peak_checked_out": 0,
+            "checkouts": 0,
+            "checkout_failures": 0,
+            "checkout_timeouts": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+            "pool_clears": 0,
+        }
+
+    def snapshot(self):
+        with self.lock:
+            counts = dict(self.counts)
+        counts["max_pool_size"] = app.config.get("MONGO_MAX_POOL_SIZE", 100)
+        counts["wait_ms_average"] = (
+            counts["wait_ms_total"] / counts["checkouts"]
+            if counts["checkouts"] else 0.0)
+        return counts
+
+    def connection_check_out_started(self, event):
+        self.waiting.since = time.monotonic()
+
+    def connection_checked_out(self, event):
+        waited = (time.monotonic() - getattr(
+            self.waiting, "since", time.monotonic())) * 1000
+        with self.lock:
+            self.counts["checkouts"] += 1
+            self.counts["checked_out"] += 1
+            self.counts["peak_checked_out"] = max(
+                self.counts["peak_checked_out"], self.counts["checked_out"])
+            self.counts["wait_ms_total"] += waited
+            self.counts["wait_ms_max"] = max(
+                self.counts["wait_ms_max"], waited)
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            self.counts["checkout_failures"] += 1
+            reasons = monitoring.ConnectionCheckOutFailedReason
+            if event.reason == reasons.TIMEOUT:
+                self.counts["checkout_timeouts"] += 1
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.counts["checked_out"] -= 1
+
+    def connection_created(self, event):
+        with self.lock:
+            self.counts["open_connections"] += 1
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.counts["open_connections"] -= 1
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.counts["pool_clears"] += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+pool_metrics = PoolMetrics()
+
+mongo = PyMongo(app, event_listeners=[pool_metrics], **{
+    option: app.config[config_name]
+    for option, config_name in MONGO_CLIENT_OPTIONS.items()
+    if config_name in app.config
+})
+
+READ_PREFERENCE_MODES = {
+    "primaryPreferred": read_preferences.PrimaryPreferred,
+    "secondary": read_preferences.Secondary,
+    "secondaryPreferred": read_preferences.SecondaryPreferred,
+    "nearest": read_preferences.Nearest,
+}
+
+if app.config["MONGO_READ_PREFERENCE"] in READ_PREFERENCE_MODES:
+    read_preference = READ_PREFERENCE_MODES[
+        app.config["MONGO_READ_PREFERENCE"]
+    ](max_staleness=app.config["MONGO_MAX_STALENESS_SECONDS"])
+else:
+    read_preference = read_preferences.Primary()
+
+
+def read_db():
+    """Database for the read heavy pages, which may be served
+    by a secondary. Form posts read from the primary so the user
+    sees the change they have just made.
+    """
+    if has_request_context() and request.method == "POST":
+        return mongo.db
+    return mongo.db.with_options(read_preference=read_preference)
+
+
+# Metrics
+metrics_sources = {}
+
+
+def metrics_source(name):
+    """Registers a function returning a dictionary of metrics
+    to be included in the /metrics response under name.
+    """
+    def register(source):
+        metrics_sources[name] = source
+        return source
+    return register
+
+
+@app.route("/metrics")
+def metrics():
+    token = app.config["METRICS_TOKEN"]
+    given = request.args.get("token") or request.headers.get(
+        "X-Metrics-Token", "")
+    if token and not hmac.compare_digest(given, token):
+        return render_template('404.html'), 404
+
+    return jsonify({
+        name: source() for name, source in metrics_sources.items()
+    })
+
+
+metrics_source("mongo_pool")(pool_metrics.snapshot)
+
+# Collections the in-process caches are built from
+REFERENCE_COLLECTIONS = ["alcohol", "units", "tools", "glasses"]
+WATCHED_COLLECTIONS = ["cocktails", "users"] + REFERENCE_COLLECTIONS
+
+# Identifies this worker so it can ignore its own broadcasts
+WORKER_ID = uuid.uuid4().hex
+
+invalidation_handlers = []
+cache_bus = {"pid": None, "mode": None}
+cache_bus_lock = threading.Lock()
+
+
+# Cache Invalidation Bus
+def on_invalidate(handler):
+    """Registers a function to be called with the keys of every
+    change seen on the bus. The same change can be delivered more
+    than once (by the worker that made it and by the change stream)
+    so handlers should only ever evict.
+    """
+    invalidation_handlers.append(handler)
+    return handler
+
+
+def dispatch_invalidation(keys):
+    """Passes the changed keys to every registered cache handler.
+    A broken handler is logged so it can't stop the others.
+    """
+    for handler in invalidation_handlers:
+        try:
+            handler(keys)
+        except Exception:
+            app.logger.exception("Cache invalidation handler failed")
+
+
+def broadcast_invalidation(collection, **keys):
+    """Clears this worker's caches straight away then records the
+    change in the cache_events collection so every other worker
+    clears theirs. Keys are the values caches are indexed by
+    e.g. cocktail_id, author_id, alcohol, user_id and username.
+    """
+    keys = {key: str(value) for key, value in keys.items() if value}
+    keys["collection"] = collection
+    dispatch_invalidation(keys)
+
+    if not app.config["CACHE_BUS_ENABLED"]:
+        return
+
+    try:
+        mongo.db.cache_events.insert_one(dict(keys, origin=WORKER_ID))
+    except PyMongoError:
+        app.logger.exception("Could not broadcast cache invalidation")
+
+
+def change_to_keys(change):
+    """Turns a change stream event into the keys the caches use.
+    Deletes only carry the document id so the explicit broadcast
+    in cache_events fills in the author and alcohol.
+    """
+    collection = change["ns"]["coll"]
+    doc = change.get("fullDocument") or {}
+
+    if collection == "cache_events":
+        if doc.get("origin") == WORKER_ID:
+            return None
+        return {
+            key: value for key, value in doc.items()
+            if key not in ("_id", "origin")
+        }
+
+    keys = {"collection": collection}
+    doc_id = str(change["documentKey"]["_id"])
+
+    updated = change.get("updateDescription", {}).get("updatedFields", {})
+
+    if collection == "cocktails":
+        keys["cocktail_id"] = doc_id
+        keys["author_id"] = doc.get("author_id")
+
+        # The alcohol it moved from isn't known, so leaving it out
+        # clears every alcohol's cached copies
+        if "alcohol" not in updated:
+            keys["alcohol"] = doc.get("alcohol")
+
+    elif collection == "users":
+        keys["user_id"] = doc_id
+
+        # Only pass the username on when it may have changed
+        if change["operationType"] != "update" or "username" in updated:
+            keys["username"] = doc.get("username")
+
+    return {key: value for key, value in keys.items() if value}
+
+
+def watch_changes():
+    """Follows a change stream over the cached collections and the
+    cache_events collection, resuming after network errors. Returns
+    False if the server can't run change streams (standalone mongod).
+    """
+    pipeline = [{"$match": {
+        "ns.coll": {"$in": WATCHED_COLLECTIONS + ["cache_events"]}
+    }}]
+    resume_token = None
+
+    while True:
+        try:
+            with mongo.db.watch(
+                pipeline,
+                full_document="updateLookup",
+                resume_after=resume_token
+            ) as stream:
+                cache_bus["mode"] = "change-stream"
+                for change in stream:
+                    resume_token = stream.resume_token
+                    keys = change_to_keys(change)
+                    if keys:
+                        dispatch_invalidation(keys)
+
+        except OperationFailure as e:
+            # Change streams need a replica set
+            if e.code == 40573 or "replica set" in str(e):
+                return False
+
+            # Resume token has fallen off the oplog so changes were missed
+            app.logger.warning("Change stream lost, clearing caches")
+            resume_token = None
+            dispatch_invalidation({"collection": "*"})
+
+        except PyMongoError:
+            app.logger.exception("Change stream failed, retrying")
+            time.sleep(app.config["CACHE_BUS_POLL_INTERVAL"])
+
+
+def poll_cache_events():
+    """Polling fallback for standalone mongod. Reads recent
+    cache_events by ObjectId time, looking back a second further
+    than the poll interval as ids from different workers aren't
+    strictly in order. Writes made outside the app aren't seen.
+    """
+    cache_bus["mode"] = "polling"
+    interval = app.config["CACHE_BUS_POLL_INTERVAL"]
+    lookback = datetime.timedelta(seconds=interval + 1)
+    seen = {}
+
+    while True:
+        window_start = ObjectId.from_datetime(
+            datetime.datetime.utcnow() - lookback)
+        try:
+            events = list(mongo.db.cache_events.find(
+                {"_id": {"$gte": window_start}}
+            ).sort("_id", 1))
+        except PyMongoError:
+            app.logger.exception("Polling cache events failed")
+            events = []
+
+        for event in events:
+            if event["_id"] in seen or event.get("origin") == WORKER_ID:
+                continue
+            seen[event["_id"]] = True
+            dispatch_invalidation({
+                key: value for key, value in event.items()
+                if key not in ("_id", "origin")
+            })
+
+        # Forget events that have left the lookback window
+        seen = {
+            event_id: True for event_id in seen
+            if event_id >= window_start
+        }
+        time.sleep(interval)
+
+
+@metrics_source("cache_bus")
+def cache_bus_metrics():
+    return {"mode": cache_bus["mode"], "handlers": len(invalidation_handlers)}
+
+
+def run_cache_bus():
+    if not watch_changes():
+        poll_cache_events()
+
+
+@app.before_request
+def start_cache_bus():
+    """Starts the bus listener once per worker process. Checking
+    the pid means forked workers start their own listener.
+    """
+    if not app.config["CACHE_BUS_ENABLED"]:
+        return
+
+    with cache_bus_lock:
+        if cache_bus["pid"] == os.getpid():
+            return
+        cache_bus["pid"] = os.getpid()
+
+    # Capped so old events age out on their own
+    try:
+        mongo.db.create_collection(
+            "cache_events", capped=True, size=1024 * 1024)
+    except (CollectionInvalid, OperationFailure):
+        pass
+
+    threading.Thread(
+        target=run_cache_bus, name="cache-bus", daemon=True
+    ).start()
+
+
+# Reference Data Cache
+reference_cache = {}
+reference_cache_generation = {}
+
+
+def get_reference(collection):
+    """Returns the documents of a reference collection e.g. alcohol
+    from the worker's cache, loading them from the database on a
+    miss. A load that overlaps an invalidation isn't stored.
+    """
+    docs = reference_cache.get(collection)
+    if docs is None:
+        generation = reference_cache_generation.get(collection, 0)
+        docs = list(mongo.db[collection].find())
+        if reference_cache_generation.get(collection, 0) == generation:
+            reference_cache[collection] = docs
+
+    return docs
+
+
+@on_invalidate
+def invalidate_reference(keys):
+    if keys["collection"] == "*":
+        collections = REFERENCE_COLLECTIONS
+    elif keys["collection"] in REFERENCE_COLLECTIONS:
+        collections = [keys["collection"]]
+    else:
+        return
+
+    for collection in collections:
+        reference_cache_generation[collection] = (
+            reference_cache_generation.get(collection, 0) + 1)
+        reference_cache.pop(collection, None)
+
+
+# Cocktail Cache
+class CocktailCache:
+    """Least recently used cache of full cocktail documents for the
+    recipe page. Loads are single flight, when many requests miss on
+    the same cocktail one of them queries and the rest wait for its
+    result. Documents are shared between requests so must not be
+    changed by the caller.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.docs = OrderedDict()
+        self.loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.waits = 0
+        self.evictions = 0
+
+    def get(self, cocktail_id, load):
+        """Returns the cached document or the result of load(),
+        which is only called by the first request to miss.
+        """
+        with self.lock:
+            if cocktail_id in self.docs:
+                self.docs.move_to_end(cocktail_id)
+                self.hits += 1
+                return self.docs[cocktail_id]
+
+            self.misses += 1
+            flight = self.loading.get(cocktail_id)
+            if flight is None:
+                flight = {
+                    "done": threading.Event(),
+                    "doc": None,
+                    "error": None,
+                    "valid": True,
+                }
+                self.loading[cocktail_id] = flight
+                leader = True
+            else:
+                self.waits += 1
+                leader = False
+
+        if not leader:
+            flight["done"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["doc"]
+
+        try:
+            self.loads += 1
+            flight["doc"] = load()
+        except Exception as error:
+            flight["error"] = error
+            raise
+        finally:
+            with self.lock:
+                if self.loading.get(cocktail_id) is flight:
+                    del self.loading[cocktail_id]
+                # Missing cocktails aren't kept so a new one is found
+                if flight["valid"] and flight["doc"] is not None:
+                    self.store(cocktail_id, flight["doc"])
+            flight["done"].set()
+
+        return flight["doc"]
+
+    def put(self, cocktail_id, doc):
+        with self.lock:
+            self.store(cocktail_id, doc)
+
+    def store(self, cocktail_id, doc):
+        if self.size <= 0:
+            return
+        self.docs[cocktail_id] = doc
+        self.docs.move_to_end(cocktail_id)
+        while len(self.docs) > self.size:
+            self.docs.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, cocktail_id):
+        """Drops the document, a load already running for it is
+        left to finish but its result isn't stored and later
+        requests start their own.
+        """
+        with self.lock:
+            self.docs.pop(cocktail_id, None)
+            flight = self.loading.pop(cocktail_id, None)
+            if flight:
+                flight["valid"] = False
+
+    def invalidate_author(self, author_id):
+        with self.lock:
+            for cocktail_id, doc in list(self.docs.items()):
+                if doc.get("author_id") == author_id:
+                    del self.docs[cocktail_id]
+            for flight in self.loading.values():
+                flight["valid"] = False
+
+    def clear(self):
+        with self.lock:
+            self.docs.clear()
+            for flight in self.loading.values():
+                flight["valid"] = False
+            self.loading.clear()
+
+
+cocktail_cache = CocktailCache(app.config["COCKTAIL_CACHE_SIZE"])
+
+
+def get_cocktail(cocktail_id):
+    """Returns a cocktail document through the cocktail cache,
+    None if there is no cocktail with this id. Misses are read from
+    the primary, a lagging secondary could put a document back in
+    the cache that an invalidation has just taken out.
+    """
+    cocktail_id = str(cocktail_id)
+    return cocktail_cache.get(
+        cocktail_id,
+        lambda: mongo.db.cocktails.find_one({"_id": ObjectId(cocktail_id)})
+    )
+
+
+@on_invalidate
+def invalidate_cocktails(keys):
+    if keys["collection"] == "*":
+        cocktail_cache.clear()
+    elif keys["collection"] == "cocktails":
+        if "cocktail_id" in keys:
+            cocktail_cache.invalidate(keys["cocktail_id"])
+        # Renames and deleted profiles change every cocktail by the author
+        elif "author_id" in keys:
+            cocktail_cache.invalidate_author(keys["author_id"])
+
+
+@metrics_source("cocktail_cache")
+def cocktail_cache_metrics():
+    return {
+        "size": len(cocktail_cache.docs),
+        "max_size": cocktail_cache.size,
+        "hits": cocktail_cache.hits,
+        "misses": cocktail_cache.misses,
+        "loads": cocktail_cache.loads,
+        "waits": cocktail_cache.waits,
+        "evictions": cocktail_cache.evictions,
+    }
+
+
+# Database Indexes
+INDEXES = {
+    "users": [
+        [("username", 1)],
+    ],
+    "trending": [
+        [("alcohol", 1), ("score", -1)],
+        [("score", -1)],
+        [("author_id", 1)],
+    ],
+    "jobs": [
+        [("status", 1), ("run_at", 1)],
+    ],
+    "user_cocktails": [
+        [("user_id", 1), ("kind", 1), ("cocktail_id", 1)],
+        [("user_id", 1), ("kind", 1), ("date_added", -1)],
+        [("cocktail_id", 1), ("kind", 1)],
+    ],
+}
+
+UNIQUE_INDEXES = {
+    "users": [[("username", 1)]],
+    "user_cocktails": [[("user_id", 1), ("kind", 1), ("cocktail_id", 1)]],
+}
+
+
+@app.before_first_request
+def create_indexes():
+    """Makes sure the indexes the queries rely on exist.
+    create_index does nothing if the index is already there.
+    """
+    for collection, indexes in INDEXES.items():
+        for index in indexes:
+            try:
+                mongo.db[collection].create_index(
+                    index, unique=index in UNIQUE_INDEXES.get(collection, []))
+            except PyMongoError:
+                app.logger.exception(f"Could not create {collection} index")
+
+
+# Username Index
+class BloomFilter:
+    """Fixed size set that can say an item is definitely not in
+    it. Items can't be removed, so the index rebuilds it once
+    enough names have been deleted.
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(64, int(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, item):
+        # Double hashing, two halves of one digest give every position
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [
+            (first + i * second) % self.size for i in range(self.hashes)
+        ]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(item)
+        )
+
+
+class UsernameIndex:
+    """In memory copy of every username so searches that can't be
+    a username skip the users query. The bloom filter answers most
+    misses, the exact set rules out its false positives. Loaded on
+    first use and kept current through the cache invalidation bus.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = None
+        self.bloom = None
+        self.removed = 0
+        self.skipped = 0
+
+    def load(self):
+        names = {
+            user["username"]
+            for user in mongo.db.users.find({}, {"username": 1})
+            if user.get("username")
+        }
+        with self.lock:
+            self.names = names
+            self.rebuild_bloom()
+            return self.names, self.bloom
+
+    def reset(self):
+        """Drops the index, the next lookup loads it again"""
+        with self.lock:
+            self.names = None
+            self.bloom = None
+
+    def rebuild_bloom(self):
+        bloom = BloomFilter(max(1024, len(self.names) * 2))
+        for name in self.names:
+            bloom.add(name)
+        self.bloom = bloom
+        self.removed = 0
+
+    def might_exist(self, username):
+        """False if no user has this name. True means the
+        database should be asked as the index may be behind.
+        """
+        # Read once as a reset can happen part way through
+        names, bloom = self.names, self.bloom
+        if names is None or bloom is None:
+            names, bloom = self.load()
+
+        if username in bloom and username in names:
+            return True
+
+        self.skipped += 1
+        return False
+
+    def add(self, username):
+        with self.lock:
+            if self.names is None:
+                return
+            self.names.add(username)
+            if len(self.names) > self.bloom.capacity:
+                self.rebuild_bloom()
+            else:
+                self.bloom.add(username)
+
+    def remove(self, username):
+        with self.lock:
+            if self.names is not None and username in self.names:
+                self.names.discard(username)
+                self.removed += 1
+                # Stale bits make the filter less useful so start again
+                if self.removed > len(self.names) // 4:
+                    self.rebuild_bloom()
+
+    def refresh(self, usernames):
+        """Checks the given names against the database, used when
+        a user has registered, been renamed or been deleted.
+        """
+        if self.names is None:
+            return
+
+        for username in usernames:
+            if mongo.db.users.find_one({"username": username}, {"_id": 1}):
+                self.add(username)
+            else:
+                self.remove(username)
+
+
+usernames = UsernameIndex()
+
+
+@on_invalidate
+def invalidate_usernames(keys):
+    if keys["collection"] == "*":
+        usernames.reset()
+    elif keys["collection"] == "users":
+        usernames.refresh([
+            keys[key] for key in ("username", "old_username") if key in keys
+        ])
+
+
+@metrics_source("usernames")
+def username_metrics():
+    names = usernames.names
+    return {
+        "loaded": names is not None,
+        "usernames": len(names or ()),
+        "skipped_lookups": usernames.skipped,
+    }
+
+
+# Server Side Sessions
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data kept on the server, the cookie only holds
+    the signed session id.
+    """
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+
+    def regenerate(self):
+        """Moves the session to a new id, used when a user signs in
+        so an id someone got hold of beforehand is no use to them.
+        The old record is deleted when the session is saved.
+        """
+        if self.previous_sid is None and not self.new:
+            self.previous_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+class MemorySessionStore:
+    """Keeps sessions in the worker's memory. Sessions are lost
+    on restart and aren't shared between workers.
+    """
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+        self.writes = 0
+
+    def get(self, sid):
+        record = self.records.get(sid)
+        if not record or record["expires"] < time.time():
+            return None, False
+        return record["data"], record["stale"]
+
+    def set(self, sid, data, user_id, expires):
+        with self.lock:
+            self.records[sid] = {
+                "data": data,
+                "user_id": user_id,
+                "expires": expires,
+                "stale": False
+            }
+            self.writes += 1
+
+            # Clear out expired sessions every so often
+            if self.writes % 1000 == 0:
+                now = time.time()
+                self.records = {
+                    key: record for key, record in self.records.items()
+                    if record["expires"] >= now
+                }
+
+    def delete(self, sid):
+        self.records.pop(sid, None)
+
+    def mark_stale(self, user_id):
+        for record in list(self.records.values()):
+            if user_id is None or record["user_id"] == user_id:
+                record["stale"] = True
+
+
+class SQLiteSessionStore:
+    """Keeps sessions in a local SQLite file so they survive
+    restarts and can be shared by workers on the same machine.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+        self.connection().execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "sid TEXT PRIMARY KEY, data BLOB, user_id TEXT, "
+            "expires REAL, stale INTEGER DEFAULT 0)"
+        )
+        self.connection().execute(
+            "CREATE INDEX IF NOT EXISTS sessions_user_id "
+            "ON sessions (user_id)"
+        )
+
+    def connection(self):
+        # SQLite connections can't be shared between threads
+        if not hasattr(self.local, "connection"):
+            self.local.connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None)
+            self.local.connection.execute("PRAGMA journal_mode=WAL")
+        return self.local.connection
+
+    def get(self, sid):
+        row = self.connection().execute(
+            "SELECT data, stale FROM sessions WHERE sid = ? AND expires >= ?",
+            (sid, time.time())
+        ).fetchone()
+        if not row:
+            return None, False
+        return pickle.loads(row[0]), bool(row[1])
+
+    def set(self, sid, data, user_id, expires):
+        self.connection().execute(
+            "INSERT OR REPLACE INTO sessions "
+            "(sid, data, user_id, expires, stale) VALUES (?, ?, ?, ?, 0)",
+            (sid, pickle.dumps(data), user_id, expires)
+        )
+        self.writes += 1
+        if self.writes % 1000 == 0:
+            self.connection().execute(
+                "DELETE FROM sessions WHERE expires < ?", (time.time(),))
+
+    def delete(self, sid):
+        self.connection().execute(
+            "DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def mark_stale(self, user_id):
+        if user_id is None:
+            self.connection().execute("UPDATE sessions SET stale = 1")
+        else:
+            self.connection().execute(
+                "UPDATE sessions SET stale = 1 WHERE user_id = ?",
+                (user_id,)
+            )
+
+
+class ServerSessionInterface(SessionInterface):
+    """Loads and saves sessions from a server side store. Stale
+    sessions have their cached user state dropped so it is
+    reloaded from the database.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        signer = Signer(app.secret_key, salt="server-session")
+        cookie = request.cookies.get(app.session_cookie_name)
+
+        if cookie:
+            try:
+                sid = signer.unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+
+            if sid:
+                data, stale = self.store.get(sid)
+                if data is not None:
+                    session = ServerSession(data, sid=sid)
+                    if stale:
+                        for key in USER_STATE_KEYS:
+                            session.pop(key, None)
+                        session.modified = True
+                    return session
+
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.previous_sid is not None:
+            self.store.delete(session.previous_sid)
+
+        # Nothing left in the session so forget it
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(
+                    app.session_cookie_name, domain=domain, path=path)
+            return
+
+        if not session.modified and not session.new:
+            return
+
+        self.store.set(
+            session.sid,
+            dict(session),
+            session.get("id"),
+            time.time() + app.config["SESSION_IDLE_TIMEOUT"]
+        )
+
+        signer = Signer(app.secret_key, salt="server-session")
+        response.set_cookie(
+            app.session_cookie_name,
+            signer.sign(session.sid).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app)
+        )
+
+
+if app.config["SESSION_STORE"] == "sqlite":
+    session_store = SQLiteSessionStore(app.config["SESSION_SQLITE_PATH"])
+else:
+    session_store = MemorySessionStore()
+
+app.session_interface = ServerSessionInterface(session_store)
+
+# Session keys holding cached copies of the user's edges
+USER_STATE_KEYS = ["bookmarks", "rated_cocktails"]
+
+# Edge kind in user_cocktails for each session key
+EDGE_KINDS = {"bookmarks": "bookmark", "rated_cocktails": "rating"}
+
+
+@on_invalidate
+def invalidate_user_state(keys):
+    if keys["collection"] == "*":
+        session_store.mark_stale(None)
+    elif keys["collection"] == "users" and keys.get("user_id"):
+        session_store.mark_stale(keys["user_id"])
+
+
+def get_user_state(key):
+    """Returns the session user's bookmarks or rated_cocktails
+    as a set of cocktail ids. The sets are loaded from the user's
+    edges once and kept in the session so membership checks
+    don't need the database.
+    """
+    if not session.get("user"):
+        return set()
+
+    if key not in session:
+        session.update(load_user_state(session["id"]))
+
+    return session[key]
+
+
+# User Cocktail Edges
+def load_user_state(user_id):
+    """Reads a user's bookmarks and rated cocktails from the
+    user_cocktails collection. Ids still in the arrays on the user
+    document, from before flask migrate-edges was run, are included
+    so nothing goes missing part way through a migration.
+    """
+    user = mongo.db.users.find_one(
+        {"_id": ObjectId(user_id)}, {key: 1 for key in USER_STATE_KEYS}
+    ) or {}
+    state = {key: set(user.get(key) or []) for key in USER_STATE_KEYS}
+
+    keys = {kind: key for key, kind in EDGE_KINDS.items()}
+    for edge in mongo.db.user_cocktails.find(
+        {"user_id": user_id}, {"_id": 0, "kind": 1, "cocktail_id": 1}
+    ):
+        state[keys[edge["kind"]]].add(edge["cocktail_id"])
+
+    return state
+
+
+def add_edge(user_id, cocktail_id, kind, **fields):
+    """Records that a user bookmarked or rated a cocktail. The
+    unique index means a repeat only updates the extra fields.
+    """
+    update = {"$setOnInsert": {"date_added": datetime.datetime.utcnow()}}
+
+    # Servers before MongoDB 5.0 refuse an empty $set
+    if fields:
+        update["$set"] = fields
+
+    mongo.db.user_cocktails.update_one(
+        {"user_id": user_id, "kind": kind, "cocktail_id": cocktail_id},
+        update,
+        upsert=True
+    )
+
+
+def remove_edge(user_id, cocktail_id, kind):
+    """Removes a bookmark or rating, returning the removed edge or
+    None if it was only in the user document.
+    """
+    edge = mongo.db.user_cocktails.find_one_and_delete(
+        {"user_id": user_id, "kind": kind, "cocktail_id": cocktail_id})
+
+    # Not yet migrated ids are still in the user document
+    key = {kind: key for key, kind in EDGE_KINDS.items()}[kind]
+    mongo.db.users.update_one(
+        {"_id": ObjectId(user_id)}, {"$pull": {key: cocktail_id}})
+
+    return edge
+
+
+def remove_cocktail_edges(cocktail_ids):
+    """Removes the bookmarks and ratings of deleted cocktails and
+    returns the ids of the users who had them.
+    """
+    user_ids = set(mongo.db.user_cocktails.distinct(
+        "user_id", {"cocktail_id": {"$in": cocktail_ids}}))
+    mongo.db.user_cocktails.delete_many(
+        {"cocktail_id": {"$in": cocktail_ids}})
+
+    # Not yet migrated ids are still in the user documents
+    for key in USER_STATE_KEYS:
+        legacy_query = {key: {"$in": cocktail_ids}}
+        user_ids.update(
+            str(user["_id"])
+            for user in mongo.db.users.find(legacy_query, {"_id": 1})
+        )
+        mongo.db.users.update_many(
+            legacy_query, {"$pull": {key: {"$in": cocktail_ids}}})
+
+    return user_ids
+
+
+@app.cli.command("migrate-edges")
+def migrate_edges():
+    """Moves bookmarks and rated cocktails out of the arrays on
+    user documents into the user_cocktails collection. Safe to run
+    more than once, users that have been moved are skipped.
+    """
+    create_indexes()
+    now = datetime.datetime.utcnow()
+    migrated = 0
+
+    users = mongo.db.users.find(
+        {"$or": [{key: {"$exists": True}} for key in USER_STATE_KEYS]},
+        {key: 1 for key in USER_STATE_KEYS}
+    )
+    for user in users:
+        user_id = str(user["_id"])
+        operations = []
+        for key, kind in EDGE_KINDS.items():
+            cocktail_ids = user.get(key) or []
+
+            # Arrays are oldest first, so the dates keep that order
+            for position, cocktail_id in enumerate(cocktail_ids):
+                date_added = now - datetime.timedelta(
+                    milliseconds=len(cocktail_ids) - position)
+                operations.append(UpdateOne(
+                    {
+                        "user_id": user_id,
+                        "kind": kind,
+                        "cocktail_id": cocktail_id
+                    },
+                    {"$setOnInsert": {
+                        "date_added": date_added,
+                        "migrated": True
+                    }},
+                    upsert=True
+                ))
+
+        if operations:
+            mongo.db.user_cocktails.bulk_write(operations, ordered=False)
+
+        # Only the ids that were copied are taken out
+        mongo.db.users.update_one({"_id": user["_id"]}, {"$pullAll": {
+            key: user.get(key) or [] for key in USER_STATE_KEYS
+        }})
+        for key in USER_STATE_KEYS:
+            mongo.db.users.update_one(
+                {"_id": user["_id"], key: {"$size": 0}},
+                {"$unset": {key: ""}}
+            )
+
+        migrated += 1
+
+    click.echo(f"Moved the bookmarks and ratings of {migrated} users")
+
+
+# Duplicate Submit Protection
+class MemoryIdempotencyStore:
+    """Remembers used form tokens in the worker's memory. The oldest
+    tokens are dropped once there are more than max_keys.
+    """
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def claim(self, key, expires):
+        with self.lock:
+            now = time.time()
+            if self.keys.get(key, 0) >= now:
+                return False
+
+            self.keys[key] = expires
+            self.keys.move_to_end(key)
+
+            # Tokens are claimed in order so expired ones are at the front
+            while self.keys and (
+                len(self.keys) > self.max_keys or
+                next(iter(self.keys.values())) < now
+            ):
+                self.keys.popitem(last=False)
+            return True
+
+    def release(self, key):
+        with self.lock:
+            self.keys.pop(key, None)
+
+
+class SQLiteIdempotencyStore:
+    """Remembers used form tokens in the session SQLite file so a
+    form re sent to another worker is still caught.
+    """
+    def __init__(self, path, max_keys):
+        self.path = path
+        self.max_keys = max_keys
+        self.local = threading.local()
+        self.writes = 0
+        self.connection().execute(
+            "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+            "key TEXT PRIMARY KEY, expires REAL)"
+        )
+
+    def connection(self):
+        if not hasattr(self.local, "connection"):
+            self.local.connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None)
+            self.local.connection.execute("PRAGMA journal_mode=WAL")
+        return self.local.connection
+
+    def claim(self, key, expires):
+        connection = self.connection()
+        connection.execute(
+            "DELETE FROM idempotency_keys WHERE key = ? AND expires < ?",
+            (key, time.time())
+        )
+        claimed = connection.execute(
+            "INSERT OR IGNORE INTO idempotency_keys (key, expires) "
+            "VALUES (?, ?)", (key, expires)
+        ).rowcount == 1
+
+        self.writes += 1
+        if self.writes % 1000 == 0:
+            connection.execute(
+                "DELETE FROM idempotency_keys WHERE expires < ?",
+                (time.time(),)
+            )
+            connection.execute(
+                "DELETE FROM idempotency_keys WHERE key NOT IN ("
+                "SELECT key FROM idempotency_keys "
+                "ORDER BY expires DESC LIMIT ?)", (self.max_keys,)
+            )
+        return claimed
+
+    def release(self, key):
+        self.connection().execute(
+            "DELETE FROM idempotency_keys WHERE key = ?", (key,))
+
+
+if app.config["SESSION_STORE"] == "sqlite":
+    idempotency_store = SQLiteIdempotencyStore(
+        app.config["SESSION_SQLITE_PATH"],
+        app.config["IDEMPOTENCY_MAX_KEYS"]
+    )
+else:
+    idempotency_store = MemoryIdempotencyStore(
+        app.config["IDEMPOTENCY_MAX_KEYS"])
+
+
+@app.template_global()
+def form_token():
+    """A new token for each rendered form, sent back as random"""
+    return uuid.uuid4().hex
+
+
+def is_duplicate_submit():
+    """True if the form's token has been used before, i.e. a reload
+    or double click sent the form again. Checked before any database
+    work. Forms without a token can't be told apart so always go
+    through.
+    """
+    token = request.form.get("random")
+    if not token:
+        return False
+
+    key = f"{session.get('id') or session.sid}:{request.endpoint}:{token}"
+    expires = time.time() + app.config["IDEMPOTENCY_TTL"]
+    if not idempotency_store.claim(key, expires):
+        return True
+
+    g.setdefault("idempotency_keys", []).append(key)
+    return False
+
+
+@app.teardown_request
+def release_idempotency_keys(error):
+    """A form whose request failed can be sent again"""
+    if error is not None:
+        for key in g.get("idempotency_keys", []):
+            idempotency_store.release(key)
+
+
+# Password Hashing Pool
+class HashPoolBusy(Exception):
+    """Raised when too many passwords are already waiting to be hashed"""
+
+
+hash_pool = {"pid": None, "executor": None}
+hash_pool_lock = threading.Lock()
+hash_pool_slots = threading.BoundedSemaphore(app.config["HASH_QUEUE_LIMIT"])
+
+
+def run_hash(function, *args):
+    """Runs a werkzeug hash function in the worker process pool so
+    a burst of logins can't tie up every request thread. Only
+    HASH_QUEUE_LIMIT hashes can be in flight at once, past that
+    HashPoolBusy is raised straight away rather than queueing.
+    """
+    if app.config["HASH_POOL_SIZE"] < 1:
+        return function(*args)
+
+    if not hash_pool_slots.acquire(blocking=False):
+        raise HashPoolBusy()
+
+    try:
+        # Pools can't be shared with forked workers
+        with hash_pool_lock:
+            if hash_pool["pid"] != os.getpid():
+                hash_pool["executor"] = ProcessPoolExecutor(
+                    max_workers=app.config["HASH_POOL_SIZE"])
+                hash_pool["pid"] = os.getpid()
+
+        future = hash_pool["executor"].submit(function, *args)
+    except Exception:
+        hash_pool_slots.release()
+        raise
+
+    # A hash that has started can't be cancelled, so its slot is only
+    # given back once it has actually finished
+    future.add_done_callback(lambda done: hash_pool_slots.release())
+    try:
+        return future.result(timeout=app.config["HASH_TIMEOUT"])
+    except FutureTimeoutError:
+        future.cancel()
+        raise HashPoolBusy()
+
+
+def hash_password(password):
+    return run_hash(
+        generate_password_hash,
+        password,
+        app.config["PASSWORD_HASH_METHOD"],
+        app.config["PASSWORD_SALT_LENGTH"]
+    )
+
+
+def needs_rehash(password_hash):
+    """Checks if a stored hash was made with different settings
+    to the current ones. Werkzeug hashes are method$salt$hash.
+    """
+    method, salt = password_hash.split("$")[:2]
+    return (
+        method != app.config["PASSWORD_HASH_METHOD"] or
+        len(salt) != app.config["PASSWORD_SALT_LENGTH"]
+    )
 
 
 # Set accessible variables
@@ -26,10 +1505,10 @@ def get_db_collections():
     dictonaries that aren't changed / updated offend if at all.
     User can't edit these dictionaries.
     """
-    alcohol_categories = list(mongo.db.alcohol.find())
-    units = list(mongo.db.units.find())
-    tools = list(mongo.db.tools.find())
-    glasses = list(mongo.db.glasses.find())
+    alcohol_categories = get_reference("alcohol")
+    units = get_reference("units")
+    tools = get_reference("tools")
+    glasses = get_reference("glasses")
     return dict(
         alcohol_categories=alcohol_categories,
         units=units,
@@ -48,86 +1527,38 @@ def home(alcohol_name):
     will cause the alcohol filter to run and only cocktails that
     use that alochol will be presenteed on the page.
     """
+    # Reads may be served by a secondary
+    db = read_db()
+
     # Alcohol Filter
     if alcohol_name:
-        alcohol = mongo.db.alcohol.find_one({"alcohol_name": alcohol_name})
+        alcohol = next((
+            alcohol for alcohol in get_reference("alcohol")
+            if alcohol["alcohol_name"] == alcohol_name
+        ), None)
         # Catch bad url, alcohol_name will accept anything as correct
         if not alcohol:
             return render_template('404.html'), 404
 
-        # Alcohol Newly Added
-        newest = list(mongo.db.cocktails.find({
-            "alcohol": alcohol_name.lower()}
-        ).sort(
-            "date_added", -1
-        ).limit(18))
-
-        # Alcohol Top Rated
-        top_rated = list(mongo.db.cocktails.find(
-            {"alcohol": alcohol_name.lower()}
-        ).sort(
-            [("rating", -1), ("no_rating", -1)]
-        ).limit(18))
-
-        # Alcohol Most Popular
-        popular = list(mongo.db.cocktails.find(
-            {"alcohol": alcohol_name.lower()}
-        ).sort(
-            [("no_of_bookmarks", -1), ("no_rating", -1)]
-        ).limit(18))
-
-        # Alcohol Featured Cocktail
-        mixology_cocktials = list(mongo.db.cocktails.find({
+        featured_query = {
             "alcohol": alcohol_name.lower(),
             "author_id": "60255ef95f5d67939e673ce2"
-        }).sort(
-            [("no_of_bookmarks", -1), ("no_rating", -1)]
-        ).limit(1))
-
-        featured_cocktail = mixology_cocktials[0]
-
-        # Add the arrangements into a list for template to iterate
-        sort_cats = [
-            {"name": "Newly Added", "cocktails": newest},
-            {"name": "Top Rated", "cocktails": top_rated},
-            {"name": "Most Popular", "cocktails": popular}
-        ]
+        }
 
     # Homepage
     else:
         alcohol = None
-        # Sort Cocktails into different arrangements
+        featured_query = {"author_id": "60255ef95f5d67939e673ce2"}
 
-        # Newly Added
-        newest = list(mongo.db.cocktails.find().sort(
-            "date_added", -1
-        ).limit(18))
-
-        # Top Rated
-        top_rated = list(mongo.db.cocktails.find().sort(
-            [("rating", -1), ("no_rating", -1)]
-        ).limit(18))
-
-        # Most Popular
-        popular = list(mongo.db.cocktails.find().sort(
-            "no_of_bookmarks", -1
-        ).limit(18))
-
-        # Featured Cocktail
-        mixology_cocktials = list(mongo.db.cocktails.find({
-            "author_id": "60255ef95f5d67939e673ce2"
-        }).sort(
-            [("no_of_bookmarks", -1), ("no_rating", -1)]
-        ).limit(1))
+    # Sort Cocktails into different arrangements
+    sort_cats = get_home_rails(alcohol_name)
 
-        featured_cocktail = mixology_cocktials[0]
+    # Featured Cocktail
+    mixology_cocktials = list(db.cocktails.find(featured_query).sort(
+        [("no_of_bookmarks", -1), ("no_rating", -1)]
+    ).limit(1))
 
-        # Add the arrangements into a list for template to iterate
-        sort_cats = [
-            {"name": "Newly Added", "cocktails": newest},
-            {"name": "Top Rated", "cocktails": top_rated},
-            {"name": "Most Popular", "cocktails": popular}
-        ]
+    featured_cocktail = mixology_cocktials[0]
 
     # Get user bookmarks
     user_bookmarks = get_bookmarks()
@@ -156,6 +1587,83 @@ def home(alcohol_name):
         )
 
 
+# Home Rails
+def get_rails(db, alcohol_name=None, projection=None):
+    """Returns the cocktail arrangements shown on the home page,
+    filtered to one alcohol if given, as a list of rails for
+    the template to iterate.
+    """
+    query = {"alcohol": alcohol_name.lower()} if alcohol_name else {}
+
+    # Newly Added
+    newest = list(db.cocktails.find(query, projection).sort(
+        "date_added", -1
+    ).limit(18))
+
+    # Top Rated
+    top_rated = list(db.cocktails.find(query, projection).sort(
+        [("rating", -1), ("no_rating", -1)]
+    ).limit(18))
+
+    # Most Popular
+    popular = list(db.cocktails.find(query, projection).sort(
+        [("no_of_bookmarks", -1), ("no_rating", -1)]
+    ).limit(18))
+
+    # Trending
+    trending = trending_cocktails(db, query.get("alcohol"), 18, projection)
+
+    return [
+        {"name": "Trending", "cocktails": trending},
+        {"name": "Newly Added", "cocktails": newest},
+        {"name": "Top Rated", "cocktails": top_rated},
+        {"name": "Most Popular", "cocktails": popular}
+    ]
+
+
+# Home Rails Cache
+home_rails_cache = {}
+home_rails_generation = {}
+
+
+def get_home_rails(alcohol_name=None):
+    """Returns the home page rails from the worker's cache, loading
+    them on a miss. Any cocktail change clears the rails it could
+    appear in and the rails are reloaded after HOME_RAILS_TTL as
+    well so the trending order keeps moving.
+    """
+    key = alcohol_name.lower() if alcohol_name else ""
+    cached = home_rails_cache.get(key)
+    if cached and cached["expires"] > time.monotonic():
+        return cached["rails"]
+
+    generation = home_rails_generation.get(key, 0)
+    rails = get_rails(read_db(), alcohol_name)
+    if home_rails_generation.get(key, 0) == generation:
+        home_rails_cache[key] = {
+            "rails": rails,
+            "expires": time.monotonic() + app.config["HOME_RAILS_TTL"],
+        }
+
+    return rails
+
+
+@on_invalidate
+def invalidate_home_rails(keys):
+    if keys["collection"] == "*" or (
+        keys["collection"] == "cocktails" and "alcohol" not in keys
+    ):
+        rails = list(home_rails_cache) + list(home_rails_generation)
+    elif keys["collection"] == "cocktails":
+        rails = {"", keys["alcohol"], keys.get("old_alcohol", "")}
+    else:
+        return
+
+    for key in rails:
+        home_rails_generation[key] = home_rails_generation.get(key, 0) + 1
+        home_rails_cache.pop(key, None)
+
+
 # Search
 @app.route("/search", defaults={"query": None}, methods=["GET", "POST"])
 @app.route("/search/<query>", methods=["GET", "POST"])
@@ -168,6 +1676,9 @@ def search(query):
     session user will be taken straight to the user
     profile.
     """
+    # Reads may be served by a secondary
+    db = read_db()
+
     # Get user bookmarks
     user_bookmarks = get_bookmarks()
 
@@ -188,8 +1699,11 @@ def search(query):
 
     if not query:
         query = " "
-    # Find Users
-    user = mongo.db.users.find_one({"username": query})
+    # Find Users, the username index rules out most queries
+    if usernames.might_exist(query):
+        user = db.users.find_one({"username": query})
+    else:
+        user = None
 
     # if user, takes the user straight to the user profile page
     if user:
@@ -200,58 +1714,24 @@ def search(query):
             profile_id=user["_id"]
         ))
 
-    # Find all cocktails
-    all_cocktails = list(mongo.db.cocktails.find(
-        {"$text": {"$search": query}})
-    )
-
     # Block blank searches
     if query == "":
         flash("Empty search input")
         return redirect(url_for("home"))
 
-    alcohol_categories = list(mongo.db.alcohol.find())
+    text_query = {"$text": {"$search": query}}
 
-    # Filter cocktails by alcohol
-    vodka_cocktails = []
-    whiskey_cocktails = []
-    gin_cocktails = []
-    rum_cocktails = []
-    tequila_cocktails = []
+    # Cocktail rails are cursors so they are read as the page renders
+    # If nothing matches at all skip the alcohol queries
+    if db.cocktails.find_one(text_query, {"_id": 1}):
+        cocktail_search_cats = list_page_rails(db, text_query)
+    else:
+        cocktail_search_cats = list_page_rails(None, text_query)
 
     # Used if no cocktail are found to tell user no user was found
-    user = []
-
-    # If all cocktail has at least one
-    if len(all_cocktails) > 0:
-        for alcohol in alcohol_categories:
-
-            # Create list name
-            filt = f"{str(alcohol['alcohol_name'].lower())}_cocktails"
-            cocktails = list(mongo.db.cocktails.find({
-                "$text": {
-                    "$search": query
-                },
-                "alcohol": alcohol['alcohol_name'].lower()
-            }))
-
-            if len(cocktails) > 0:
-                # Set list name as variable and extend cocktail to the
-                # corresponding list abover
-                vars()[filt].extend(cocktails)
-
-    # Stage info for template to iterate
-    cocktail_search_cats = [
-        {"name": "User", "cocktails": user},
-        {"name": "All Cocktails", "cocktails": all_cocktails},
-        {"name": "Vodka Cocktails", "cocktails": vodka_cocktails},
-        {"name": "Whiskey Cocktails", "cocktails": whiskey_cocktails},
-        {"name": "Gin Cocktails", "cocktails": gin_cocktails},
-        {"name": "Rum Cocktails", "cocktails": rum_cocktails},
-        {"name": "Tequila Cocktails", "cocktails": tequila_cocktails},
-    ]
+    cocktail_search_cats.insert(0, {"name": "User", "cocktails": []})
 
-    return render_template(
+    return render_list_page(
         "search.html",
         cocktail_search_cats=cocktail_search_cats,
         query=query,
@@ -266,6 +1746,9 @@ def view_all(order_by):
     sorts them by the users selected link value
     eg. Top Rated, Most Popular, Newly Added
     """
+    # Reads may be served by a secondary
+    db = read_db()
+
     # Get user bookmarks
     user_bookmarks = get_bookmarks()
 
@@ -288,48 +1771,30 @@ def view_all(order_by):
     elif order_by == "most-popular":
         order = "no_of_bookmarks"
 
+    # Trending scores are kept in their own collection
+    elif order_by == "trending":
+        order = None
+
     else:
         return render_template('404.html'), 404
 
-    all_cocktails = list(mongo.db.cocktails.find().sort(order, -1))
-
-    alcohol_categories = list(mongo.db.alcohol.find())
-
-    # Filter cocktails by alcohol
-    vodka_cocktails = []
-    whiskey_cocktails = []
-    gin_cocktails = []
-    rum_cocktails = []
-    tequila_cocktails = []
-
-    # If all cocktail has at least one
-    if len(all_cocktails) > 0:
-        for alcohol in alcohol_categories:
-
-            # Create list name
-            filt = f"{str(alcohol['alcohol_name'].lower())}_cocktails"
-            cocktails = list(mongo.db.cocktails.find({
-                "alcohol": alcohol['alcohol_name'].lower()
-            }).sort(
-                order, -1
-            ))
-
-            if len(cocktails) > 0:
-                # Set list name as variable and extend cocktail to the
-                # corresponding list abover
-                vars()[filt].extend(cocktails)
+    # Cocktail rails are cursors so they are read as the page renders
+    if order:
+        cocktail_search_cats = list_page_rails(db, {}, order)
 
-    # Stage info for template to iterate
-    cocktail_search_cats = [
-        {"name": "All Cocktails", "cocktails": all_cocktails},
-        {"name": "Vodka Cocktails", "cocktails": vodka_cocktails},
-        {"name": "Whiskey Cocktails", "cocktails": whiskey_cocktails},
-        {"name": "Gin Cocktails", "cocktails": gin_cocktails},
-        {"name": "Rum Cocktails", "cocktails": rum_cocktails},
-        {"name": "Tequila Cocktails", "cocktails": tequila_cocktails},
-    ]
+    # Trending scores are in their own collection so are read up front
+    else:
+        cocktail_search_cats = [
+            {"name": "All Cocktails", "cocktails": trending_cocktails(db)}
+        ] + [
+            {
+                "name": f"{alcohol.title()} Cocktails",
+                "cocktails": trending_cocktails(db, alcohol)
+            }
+            for alcohol in LIST_PAGE_ALCOHOLS
+        ]
 
-    return render_template(
+    return render_list_page(
         "view-all.html",
         order_by=order_by,
         cocktail_search_cats=cocktail_search_cats,
@@ -337,6 +1802,48 @@ def view_all(order_by):
     )
 
 
+# List Pages
+def list_page_rails(db, query, order=None):
+    """Stages the All Cocktails rail and one rail per alcohol for
+    the view all and search pages. Rails are unread cursors so
+    only the rail being rendered is held in memory. Without a
+    database every rail is empty.
+    """
+    def rail(rail_query):
+        if db is None:
+            return []
+        cocktails = db.cocktails.find(rail_query).batch_size(50)
+        if order:
+            cocktails = cocktails.sort(order, -1)
+        return cocktails
+
+    return [{"name": "All Cocktails", "cocktails": rail(query)}] + [
+        {
+            "name": f"{alcohol.title()} Cocktails",
+            "cocktails": rail(dict(query, alcohol=alcohol))
+        }
+        for alcohol in LIST_PAGE_ALCOHOLS
+    ]
+
+
+def render_list_page(template_name, **context):
+    """Renders the view all and search pages. With STREAM_LIST_PAGES
+    the page is sent as it renders, the header goes out straight
+    away and each rail is read from its cursor as it is reached.
+    """
+    if not app.config["STREAM_LIST_PAGES"]:
+        return render_template(template_name, **context)
+
+    # The session is saved before the body is sent so flashes
+    # have to be taken out of it now
+    get_flashed_messages()
+
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(16)
+    return Response(stream_with_context(stream), mimetype="text/html")
+
+
 # Login
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -354,25 +1861,41 @@ def login():
             {"username": request.form.get("login-username").lower()})
 
         if user_in_db:
+            password = request.form.get("login-password")
+
             # Check password of username matches password in datebase
-            if check_password_hash(
-                user_in_db["password"], request.form.get("login-password")
-            ):
+            try:
+                password_matches = run_hash(
+                    check_password_hash, user_in_db["password"], password)
+            except HashPoolBusy:
+                flash("Sorry we're busy, please try again")
+                return redirect(url_for("login"))
+
+            if password_matches:
 
                 # If the password matches
+                # New session id so one set before login can't be used
+                session.regenerate()
+
                 # Set Username into session cookie
                 session["user"] = request.form.get("login-username").lower()
 
                 # Set user Id into session ID-
-                session["id"] = str(mongo.db.users.find_one(
-                    {"username": request.form.get("login-username").lower()}
-                ).get(
-                    "_id"
-                ))
-
-                # Set form submit no to block against re submit on reload
-                # Set to value a random number genarator can't produce
-                session["formsubmitno"] = "nothing"
+                session["id"] = str(user_in_db["_id"])
+
+                # Upgrade the hash if the hash settings have changed
+                if needs_rehash(user_in_db["password"]):
+                    try:
+                        mongo.db.users.update_one(
+                            {"_id": user_in_db["_id"]},
+                            {"$set": {"password": hash_password(password)}}
+                        )
+                    except HashPoolBusy:
+                        # Can be done next time they log in
+                        pass
+
+                # Cache the user's bookmarks and ratings in the session
+                session.update(load_user_state(str(user_in_db["_id"])))
 
                 flash("Welcome {}".format(request.form.get("login-username")))
                 # Return the user to the home page logged in
@@ -404,14 +1927,23 @@ def register():
 
     if request.method == "POST":
         # Check username isnt already taken by another user
-        user_in_db = mongo.db.users.find_one(
-            {"username": request.form.get("reg-username").lower()})
+        if usernames.might_exist(request.form.get("reg-username").lower()):
+            user_in_db = mongo.db.users.find_one(
+                {"username": request.form.get("reg-username").lower()})
+        else:
+            user_in_db = None
 
         # Tells user if the username is taken
         if user_in_db:
             flash("Username unavailable. Please choose another.")
             return redirect(url_for("register"))
 
+        try:
+            password_hash = hash_password(request.form.get("reg-password"))
+        except HashPoolBusy:
+            flash("Sorry we're busy, please try again")
+            return redirect(url_for("register"))
+
         # Default image UR
         domain = "https://drive.google.com/"
         image_id = "uc?export=view&id=1xxYCbYNJ5bQmalWEqNgZyl8zjxnV5Id9"
@@ -419,26 +1951,28 @@ def register():
         # Stages the form information into the correct formate for db
         register = {
             "username": request.form.get("reg-username").lower(),
-            "password": generate_password_hash(
-                request.form.get("reg-password")),
-            "bookmarks": [],
+            "password": password_hash,
             "image": f"{domain}{image_id}",
-            "date_added": datetime.datetime.utcnow(),
-            "rated_cocktails": []
+            "date_added": datetime.datetime.utcnow()
         }
 
         # Add staged form information to the db
-        mongo.db.users.insert_one(register)
+        # Unique index catches a name taken since the index was updated
+        try:
+            new_user = mongo.db.users.insert_one(register)
+        except DuplicateKeyError:
+            flash("Username unavailable. Please choose another.")
+            return redirect(url_for("register"))
 
-        # Add user to session cookies
+        # Add user to session cookies, under a new session id
+        session.regenerate()
         session["user"] = request.form.get("reg-username").lower()
-        session["id"] = str(mongo.db.users.find_one(
-            {"username": request.form.get("reg-username").lower()}
-        ).get("_id"))
+        session["id"] = str(new_user.inserted_id)
+        for key in USER_STATE_KEYS:
+            session[key] = set()
 
-        # Set form submit no to block against re submit on reload
-        # Set to value a random number genarator can't produce
-        session["formsubmitno"] = "nothing"
+        broadcast_invalidation(
+            "users", user_id=session["id"], username=session["user"])
 
         # Tells user they are successfil register
         flash("Success! Thank You for signing up to Mixology")
@@ -451,14 +1985,10 @@ def register():
 @app.route("/logout")
 def logout():
     """The user is logged out by clearing their
-    session cookies. The form submission number
-    cookie is re added as it is used by over
-    function to stop forms being resubmitted on
-    reload
+    session cookies.
     """
     # Removes all session cookies
     session.clear()
-    session["formsubmitno"] = "nothing"
     # Tells user they have logged out
     flash("You have successfully logged out")
     return redirect(url_for("home"))
@@ -486,6 +2016,11 @@ def profile(profile_name, profile_id, edit):
         {"username": profile_name}
     )
 
+    # Links written before a rename job finishes still
+    # carry the old username, so fall back to the id
+    if not profile and ObjectId.is_valid(profile_id):
+        profile = mongo.db.users.find_one({"_id": ObjectId(profile_id)})
+
     if not profile:
         flash("Profile Doesn't Exist")
         return redirect(url_for("home"))
@@ -498,7 +2033,8 @@ def profile(profile_name, profile_id, edit):
             submit_bookmark(user_bookmarks)
 
         elif form_type == "update-profile":
-            update_return = update_profile(profile_name, profile_id)
+            update_return = update_profile(
+                profile["username"], profile_id)
 
             # Will reload the page in edit mode
             if update_return == "true":
@@ -514,7 +2050,7 @@ def profile(profile_name, profile_id, edit):
     )
 
     # Filter cocktail by alcohol
-    alcohol_categories = list(mongo.db.alcohol.find())
+    alcohol_categories = get_reference("alcohol")
 
     # Filter user cocktails by alcohol
     user_vodka_cocktails = []
@@ -583,19 +2119,26 @@ def delete_profile(user_id):
     by the session cookies being cleared.
     """
     # Delete profile from db
-    mongo.db.users.delete_one({"_id": ObjectId(user_id)})
+    deleted = mongo.db.users.find_one_and_delete(
+        {"_id": ObjectId(user_id)}, {"username": 1}) or {}
 
-    # Delete all cocktials in db owned by the user
-    mongo.db.cocktails.delete_many({"author_id": user_id})
+    # The user's own bookmarks and ratings
+    mongo.db.user_cocktails.delete_many({"user_id": user_id})
 
+    broadcast_invalidation(
+        "users", user_id=user_id, username=deleted.get("username"))
+
+    # Delete all cocktials in db owned by the user, in the background
+    # as a big catalogue would hold up the response
     # Clear session / log out
     session.clear()
 
-    # Set form submit no or error thrown when form submitted
-    # Set to value a random number genarator can't produce
-    session["formsubmitno"] = "nothing"
-
     flash("Profile Deleted")
+
+    if deleted:
+        job_id = enqueue_job("delete_author_cocktails", author_id=user_id)
+        flash("Your cocktails are being removed, progress: {}".format(
+            url_for("job_status", job_id=job_id)))
     return redirect(url_for("home"))
 
 
@@ -613,16 +2156,8 @@ def cocktail(cocktail_name, cocktail_id):
     handle updating the database.
     """
     # Get user bookmarks and user rated cocktails
-    if session.get('user'):
-        user_bookmarks = mongo.db.users.find_one(
-            {"username": session["user"]}).get("bookmarks")
-
-        user_rated_cocktails = mongo.db.users.find_one(
-            {"username": session["user"]}).get("rated_cocktails")
-
-    else:
-        user_rated_cocktails = []
-        user_bookmarks = []
+    user_bookmarks = get_user_state("bookmarks")
+    user_rated_cocktails = get_user_state("rated_cocktails")
 
     # Determine which form has been submitted
     if request.method == "POST":
@@ -642,7 +2177,7 @@ def cocktail(cocktail_name, cocktail_id):
     else:
         bookmark = "false"
 
-    cocktail = mongo.db.cocktails.find_one({"_id": ObjectId(cocktail_id)})
+    cocktail = get_cocktail(cocktail_id)
     return render_template(
         "cocktail.html",
         cocktail=cocktail,
@@ -659,41 +2194,25 @@ def delete_cocktail(cocktail_id):
     Bookmarks and Rated Cocktails.
     """
     # Delete cocktail from db
-    mongo.db.cocktails.delete_one({"_id": ObjectId(cocktail_id)})
-
-    # Delete cocktail form users bookmarks
-    users_booked = list(mongo.db.users.find({"bookmarks": cocktail_id}))
-    users_rated = list(mongo.db.users.find({"rated_cocktails": cocktail_id}))
-
-    # Remove Bookmarks
-    for user in users_booked:
-        if len(user["bookmarks"]) == 1:
-            removed_bookmark = []
-
-        else:
-            removed_bookmark = user["bookmarks"].remove(cocktail_id)
+    deleted = mongo.db.cocktails.find_one_and_delete(
+        {"_id": ObjectId(cocktail_id)})
 
-        # Stage user new key values
-        user_query = {"_id": ObjectId(user["_id"])}
-        user_update = {"$set": {"bookmarks":  removed_bookmark}}
+    mongo.db.trending.delete_one({"_id": cocktail_id})
 
-        # Update datebase
-        mongo.db.users.update_one(user_query, user_update)
-
-    # Remove Ratings
-    for user in users_rated:
-        if len(user["rated_cocktails"]) == 1:
-            removed_rating = []
-
-        else:
-            removed_rating = user["rated_cocktails"].remove(cocktail_id)
+    if deleted:
+        broadcast_invalidation(
+            "cocktails",
+            cocktail_id=cocktail_id,
+            author_id=deleted.get("author_id"),
+            alcohol=deleted.get("alcohol")
+        )
 
-        # Stage user new key values
-        user_query = {"_id": ObjectId(user["_id"])}
-        user_update = {"$set": {"rated_cocktails":  removed_rating}}
+    # Delete cocktail form users bookmarks and rated cocktails
+    users_affected = remove_cocktail_edges([cocktail_id])
 
-        # Update datebase
-        mongo.db.users.update_one(user_query, user_update)
+    # Cached bookmarks of these users are now out of date
+    for user_id in users_affected:
+        broadcast_invalidation("users", user_id=user_id)
 
     flash("Cocktail Deleted")
     return redirect(url_for(
@@ -718,13 +2237,8 @@ def cocktail_create(cocktail_name, cocktail_id):
     pushes this staged information to the datebase.
     """
     if request.method == "POST":
-        # Grab random number from form
-        form_random_value = request.form.get("random"),
-
         # Block against reload re submits
-        if form_random_value != session["formsubmitno"]:
-            session["formsubmitno"] = form_random_value
-
+        if not is_duplicate_submit():
             # Get the number of each input field
             ingred_count = int(request.form.get("no-of-ingred"))
             garnish_count = int(request.form.get("no-of-garnish"))
@@ -761,7 +2275,14 @@ def cocktail_create(cocktail_name, cocktail_id):
                 }
 
                 # Pushes the staged info to the datebase
-                mongo.db.cocktails.insert_one(register)
+                new_cocktail = mongo.db.cocktails.insert_one(register)
+
+                broadcast_invalidation(
+                    "cocktails",
+                    cocktail_id=new_cocktail.inserted_id,
+                    author_id=register["author_id"],
+                    alcohol=register["alcohol"]
+                )
 
                 # Gives the user feedback on a sucessful submission
                 flash("Coctail Added")
@@ -789,23 +2310,40 @@ def cocktail_create(cocktail_name, cocktail_id):
                     }
                 }
 
-                # Pushes the staged info to the datebase
-                mongo.db.cocktails.update_one(cocktail_query, edit)
+                # Pushes the staged info to the datebase, getting back
+                # the cocktail as it was so the alcohol it moved from
+                # is known, the edited copy is made from it
+                previous = mongo.db.cocktails.find_one_and_update(
+                    cocktail_query, edit,
+                    return_document=ReturnDocument.BEFORE
+                )
+                mongo.db.trending.update_one(
+                    {"_id": cocktail_id},
+                    {"$set": {"alcohol": edit["$set"]["alcohol"]}}
+                )
+
+                broadcast_invalidation(
+                    "cocktails",
+                    cocktail_id=cocktail_id,
+                    author_id=session["id"],
+                    alcohol=edit["$set"]["alcohol"],
+                    old_alcohol=(previous or {}).get("alcohol")
+                )
+
+                cocktail = None
+                if previous:
+                    cocktail = dict(previous, **edit["$set"])
+                    cocktail_cache.put(cocktail_id, cocktail)
 
                 # Gives the user feedback on a sucessful submission
                 flash("Coctail Updated")
 
-                cocktail = mongo.db.cocktails.find_one({
-                    "_id": ObjectId(cocktail_id)
-                })
                 return render_template("cocktail.html", cocktail=cocktail)
 
         else:
             if cocktail_id:
                 flash("Changes Saved")
-                cocktail = mongo.db.cocktails.find_one({
-                    "_id": ObjectId(cocktail_id)
-                })
+                cocktail = get_cocktail(cocktail_id)
                 return render_template("cocktail.html", cocktail=cocktail)
             else:
                 flash("Cocktail Already Added")
@@ -821,7 +2359,7 @@ def cocktail_create(cocktail_name, cocktail_id):
         return redirect(url_for("login"))
 
     elif cocktail_id:
-        cocktail = mongo.db.cocktails.find_one({"_id": ObjectId(cocktail_id)})
+        cocktail = get_cocktail(cocktail_id)
         if cocktail["author_id"] != session["id"]:
             flash("Unauthorized to edit cocktail")
             return redirect(
@@ -847,8 +2385,8 @@ def formate_inputs(item, count):
     Count is set by cocktail_create()
     form inputs from cocktail create form
     """
-    # Empty array to put the formated items into
-    item_formatted = []
+    # Empty array to put the form items into
+    item_values = []
 
     # Iterates through the number of a specific input
     # count must be +1 as not starting at 0
@@ -856,35 +2394,51 @@ def formate_inputs(item, count):
         if item == "tool" or item == "instruction":
 
             # Gets the item from form input
-            item_info = request.form.get(f"{item}-{x}")
-
-            # Adds item to the formatted array
-            item_formatted.append(item_info)
+            item_values.append(request.form.get(f"{item}-{x}"))
 
         elif item == "garnish":
 
             # Gets the item from form input
-            item_amount = request.form.get(f"{item}-amount-{x}")
-            item_name = request.form.get(f"{item}-name-{x}")
-
-            # Formates the inputs into a array
-            item_info = [f"{item_amount}", f"{item_name}"]
-
-            # Adds item to the formatted array
-            item_formatted.append(item_info)
+            item_values.append([
+                request.form.get(f"{item}-amount-{x}"),
+                request.form.get(f"{item}-name-{x}")
+            ])
 
         elif item == "ingredient":
 
             # Gets the item from form input
-            item_amount = request.form.get(f"{item}-amount-{x}")
-            item_unit = request.form.get(f"{item}-unit-{x}")
-            item_name = request.form.get(f"{item}-name-{x}")
+            item_values.append([
+                request.form.get(f"{item}-amount-{x}"),
+                request.form.get(f"{item}-unit-{x}"),
+                request.form.get(f"{item}-name-{x}")
+            ])
+
+    return normalise_items(item, item_values)
+
+
+def normalise_items(item, item_values):
+    """Formates a list of cocktail items into the arrays stored
+    in the datebase. Used by the cocktail form and by the import
+    command so both store the same shape.
+    """
+    # Empty array to put the formated items into
+    item_formatted = []
+
+    # Number of parts each garnish or ingredient is made of
+    parts = {"garnish": 2, "ingredient": 3}.get(item)
+
+    for item_info in item_values:
+        if parts:
+            if not isinstance(item_info, (list, tuple)) or (
+                len(item_info) != parts
+            ):
+                raise ValueError(f"{item} must have {parts} parts")
 
             # Formates the inputs into a array
-            item_info = [f"{item_amount}", f"{item_unit}", f"{item_name}"]
+            item_info = [f"{part}" for part in item_info]
 
-            # Adds item to the formatted array
-            item_formatted.append(item_info)
+        # Adds item to the formatted array
+        item_formatted.append(item_info)
 
     return item_formatted
 
@@ -897,23 +2451,31 @@ def get_bookmarked_cocktails():
     a list.
     """
     if session.get('user'):
-        # Get user bookmarked cocktial ids form db
-        bookmark_list = mongo.db.users.find_one(
-                {"username": session["user"]}).get("bookmarks")
-
-        # Empty array to add the bookmarked cocktails to
-        bookmarked_cocktial = []
-
-        # Loops through bookmark list adding cocktails from db to arary above
-        for cocktail_id in bookmark_list:
-
-            cocktail = mongo.db.cocktails.find_one(
-                {"_id": ObjectId(cocktail_id)}
-            )
+        # Get user bookmarked cocktial ids newest first
+        bookmark_list = [
+            edge["cocktail_id"] for edge in mongo.db.user_cocktails.find(
+                {"user_id": session["id"], "kind": "bookmark"},
+                {"_id": 0, "cocktail_id": 1}
+            ).sort("date_added", -1)
+        ]
 
-            bookmarked_cocktial.insert(0, cocktail)
+        # Not yet migrated bookmarks, the array is oldest first
+        user = mongo.db.users.find_one(
+            {"_id": ObjectId(session["id"])}, {"bookmarks": 1}) or {}
+        bookmark_list.extend(reversed(user.get("bookmarks") or []))
+
+        # One query for all of the cocktails, put back in bookmark order
+        cocktails = {
+            str(cocktail["_id"]): cocktail
+            for cocktail in mongo.db.cocktails.find({"_id": {"$in": [
+                ObjectId(cocktail_id) for cocktail_id in bookmark_list
+            ]}})
+        }
 
-        return bookmarked_cocktial
+        return [
+            cocktails[cocktail_id] for cocktail_id in dict.fromkeys(
+                bookmark_list) if cocktail_id in cocktails
+        ]
 
     else:
         return []
@@ -926,18 +2488,8 @@ def get_bookmarks():
     set it to an empty list so forms that
     rely on it can still function.
     """
-    if session.get('user'):
-        bookmarks = mongo.db.users.find_one(
-            {"username": session["user"]}
-        ).get(
-            "bookmarks"
-        )
-
-    # No bookmarks if no user is logged in
-    else:
-        bookmarks = []
-
-    return bookmarks
+    # Empty set if no user is logged in
+    return get_user_state("bookmarks")
 
 
 # Bookmarking
@@ -950,6 +2502,10 @@ def submit_bookmark(user_bookmarks):
         flash("You must be logged in to bookmark cocktails")
 
     else:
+        # Block against reload re submits
+        if is_duplicate_submit():
+            return
+
         cocktail_id = request.form.get("cocktail-id")
 
         cocktail = mongo.db.cocktails.find_one(
@@ -957,85 +2513,103 @@ def submit_bookmark(user_bookmarks):
 
         bookmark_count = cocktail.get("no_of_bookmarks")
 
-        # Grab random number from form
-        form_random_value = request.form.get("random"),
-
-        # Block against reload re submits
-        if form_random_value != session["formsubmitno"]:
-            session["formsubmitno"] = form_random_value
+        # Check if cocktail is already bookmarked
+        if cocktail_id in user_bookmarks:
+            # If it is remove it
+            user_bookmarks.discard(cocktail_id)
+            bookmark_count -= 1
+            edge = remove_edge(session["id"], cocktail_id, "bookmark")
 
-            # Check if cocktail is already bookmarked
-            if cocktail_id in user_bookmarks:
-                # If it is remove it
-                user_bookmarks.remove(cocktail_id)
-                bookmark_count -= 1
+            # Unbookmarking takes the bookmark's weight back off as
+            # it was when added, an older bookmark has more to undo
+            bookmarked = bookmark_date(edge, cocktail_id)
+            if bookmarked:
+                record_event(cocktail, "unbookmark", -1, bookmarked)
 
-            else:
-                # If it is NOT add it
-                user_bookmarks.append(cocktail_id)
-                bookmark_count += 1
+        else:
+            # If it is NOT add it
+            user_bookmarks.add(cocktail_id)
+            bookmark_count += 1
+            add_edge(session["id"], cocktail_id, "bookmark")
+            record_event(cocktail, "bookmark", 1)
 
-        # Stage query to find the session user
-        # Stage the data to be updated
-        query = {"_id": ObjectId(session["id"])}
-        # $set allows only one key to be updated without stating the rest
-        update = {"$set": {"bookmarks": user_bookmarks}}
+        # Sets are changed in place so the session must be told
+        session.modified = True
 
         cocktail_query = {"_id": ObjectId(cocktail_id)}
         cocktail_update = {"$set": {"no_of_bookmarks": bookmark_count}}
 
         # Update datebase
-        mongo.db.users.update_one(query, update)
         mongo.db.cocktails.update_one(cocktail_query, cocktail_update)
 
+        broadcast_invalidation("users", user_id=session["id"])
+        broadcast_invalidation(
+            "cocktails",
+            cocktail_id=cocktail_id,
+            author_id=cocktail.get("author_id"),
+            alcohol=cocktail.get("alcohol")
+        )
+
 
 # Update User Info
 def update_profile(profile_name, profile_id):
     """Stages and updates user information
     to the database.
     """
-    # Grab random number from form
-    form_random_value = request.form.get("random")
-
     # Block against reload re submits
-    if form_random_value != session["formsubmitno"]:
-        session["formsubmitno"] = form_random_value
+    if is_duplicate_submit():
+        return
 
+    if usernames.might_exist(request.form.get("username").lower()):
         user_in_db = mongo.db.users.find_one(
             {"username": request.form.get("username").lower()})
+    else:
+        user_in_db = None
 
-        prev_username = request.form.get("username")
+    prev_username = request.form.get("username").lower()
 
-        # Check username isnt already taken by another user
-        if user_in_db and profile_name != prev_username:
-            # Tells user if the username is taken
-            flash("Username unavailable. Please choose another.")
-            return "true"
+    # Check username isnt already taken by another user
+    if user_in_db and profile_name != prev_username:
+        # Tells user if the username is taken
+        flash("Username unavailable. Please choose another.")
+        return "true"
 
-        else:
-            username = request.form.get("username")
-            image_url = request.form.get("image-url")
-
-            # Stage query to find the session user
-            # Stage the data to be updated
-            query = {"_id": ObjectId(profile_id)}
-            # $set allows only one key to be updated without stating the rest
-            update = {
-                "$set": {
-                    "username": username,
-                    "image": image_url
-                }
+    else:
+        username = request.form.get("username").lower()
+        image_url = request.form.get("image-url")
+
+        # Stage query to find the session user
+        # Stage the data to be updated
+        query = {"_id": ObjectId(profile_id)}
+        # $set allows only one key to be updated without stating the rest
+        update = {
+            "$set": {
+                "username": username,
+                "image": image_url
             }
-            flash("Changes Saved")
-            session["user"] = request.form.get("username").lower()
+        }
+        try:
             mongo.db.users.update_one(query, update)
+        except DuplicateKeyError:
+            flash("Username unavailable. Please choose another.")
+            return "true"
 
-            # Update cocktail author key
-            if profile_name != prev_username:
-                cocktail_query = {"author_id": profile_id}
-                cocktail_update = {"$set": {"author": username}}
+        flash("Changes Saved")
+        session["user"] = username
 
-                mongo.db.cocktails.update_many(cocktail_query, cocktail_update)
+        broadcast_invalidation(
+            "users",
+            user_id=profile_id,
+            username=username,
+            old_username=profile_name
+        )
+
+        # Update cocktail author key, in the background as
+        # every cocktail the user wrote is rewritten
+        if profile_name != prev_username:
+            job_id = enqueue_job("rename_author", author_id=profile_id)
+            flash("Your cocktails are being updated, progress: {}".format(
+                url_for("job_status", job_id=job_id)))
 
 
 # Submit Cocktail Rating
@@ -1045,54 +2619,1716 @@ def submit_rating(user_rated_cocktails):
     user bookmark list and updates the
     database.
     """
-    # Grab random number from form
-    form_random_value = request.form.get("random")
+    # Checked before anything is written, as a value outside 1 to 5
+    # would be saved and then fail when the trending score is worked out
+    try:
+        user_rating = int(request.form.get("star-rating"))
+    except (TypeError, ValueError):
+        user_rating = None
+
+    if not session.get("user"):
+        flash("You must be logged in to bookmark cocktails")
+
+    elif user_rating not in range(1, 6):
+        flash("Please choose a rating from 1 to 5 stars")
 
     # Block against reload re submits
-    if form_random_value != session["formsubmitno"]:
-        session["formsubmitno"] = form_random_value
+    elif not is_duplicate_submit():
+        # Find cocktial
+        cocktail_id = request.form.get("cocktail-id")
 
-        if not session.get("user"):
-            flash("You must be logged in to bookmark cocktails")
+        cocktail = mongo.db.cocktails.find_one(
+            {"_id": ObjectId(cocktail_id)})
 
-        else:
-            # Find cocktial
-            cocktail_id = request.form.get("cocktail-id")
-
-            cocktail = mongo.db.cocktails.find_one(
-                {"_id": ObjectId(cocktail_id)})
-
-            # Get key values
-            user_rating = int(request.form.get("star-rating"))
-            no_rating = cocktail.get("no_rating")
-            rating_sum = cocktail.get("rating_sum")
-
-            # Work out new rating
-            no_rating += 1
-            new_rating_sum = rating_sum + user_rating
-            new_rating = new_rating_sum / no_rating
-
-            # Stage cocktial new key values
-            cocktail_query = {"_id": ObjectId(cocktail_id)}
-            cocktail_update = {
-                "$set": {
-                    "no_rating": no_rating,
-                    "rating": new_rating,
-                    "rating_sum": new_rating_sum
-                }
+        # Get key values
+        no_rating = cocktail.get("no_rating")
+        rating_sum = cocktail.get("rating_sum")
+
+        # Work out new rating
+        no_rating += 1
+        new_rating_sum = rating_sum + user_rating
+        new_rating = new_rating_sum / no_rating
+
+        # Stage cocktial new key values
+        cocktail_query = {"_id": ObjectId(cocktail_id)}
+        cocktail_update = {
+            "$set": {
+                "no_rating": no_rating,
+                "rating": new_rating,
+                "rating_sum": new_rating_sum
             }
+        }
+
+        # Add cocktail to users rated cocktails
+        # Used to stop them rating it twice
+        user_rated_cocktails.add(cocktail_id)
+        session.modified = True
+
+        # Update datebase
+        mongo.db.cocktails.update_one(cocktail_query, cocktail_update)
+        add_edge(session["id"], cocktail_id, "rating", rating=user_rating)
+
+        # 5 stars counts the same as a bookmark
+        record_event(cocktail, "rating", user_rating / 5)
+
+        broadcast_invalidation("users", user_id=session["id"])
+        broadcast_invalidation(
+            "cocktails",
+            cocktail_id=cocktail_id,
+            author_id=cocktail.get("author_id"),
+            alcohol=cocktail.get("alcohol")
+        )
+
+
+# Trending
+# Score of a cocktail with nothing left to count
+NO_SCORE = float("-inf")
 
-            # Add cocktail to users rated cocktails
-            # Used to stop them rating it twice
-            user_rated_cocktails.append(cocktail_id)
 
-            # Stage user new key values
-            user_query = {"_id": ObjectId(session["id"])}
-            user_update = {"$set": {"rated_cocktails": user_rated_cocktails}}
+def add_to_score(score, weight, when):
+    """Adds a weight to a score, scaled by how many half lives
+    after the trending epoch it happened. Every score shrinks by
+    the same amount as time passes so storing weights at their
+    epoch value keeps the order without ever rescoring.
+
+    Scores are log2 of the scaled sum as the sum itself overflows
+    a float after 1024 half lives. Logs keep the same order so the
+    score index still works.
+    """
+    half_lives = (when - app.config["TRENDING_EPOCH"]).total_seconds() / (
+        app.config["TRENDING_HALF_LIFE_HOURS"] * 60 * 60)
+    log_weight = math.log2(abs(weight)) + half_lives
+
+    if weight > 0:
+        if score == NO_SCORE:
+            return log_weight
+        high, low = max(score, log_weight), min(score, log_weight)
+        return high + math.log2(1 + 2 ** (low - high))
+
+    # Taking away as much as there is, or more, leaves nothing
+    if score == NO_SCORE or log_weight >= score:
+        return NO_SCORE
+    return score + math.log2(1 - 2 ** (log_weight - score))
+
+
+def bookmark_date(edge, cocktail_id):
+    """When the bookmark being removed was scored. Migrated edges
+    and bookmarks still in the user document only have a date if
+    the bookmark is in the event log.
+    """
+    if edge and not edge.get("migrated"):
+        return edge["date_added"]
+
+    event = mongo.db.cocktail_events.find_one(
+        {
+            "cocktail_id": cocktail_id,
+            "user_id": session.get("id"),
+            "kind": "bookmark"
+        },
+        sort=[("date_added", -1)]
+    )
+    return event["date_added"] if event else None
+
+
+def record_event(cocktail, kind, weight, scored_at=None):
+    """Appends a bookmark or rating event to the event log and
+    adds it to the cocktail's trending score. The (alcohol, score)
+    index keeps the top cocktails per alcohol in order. scored_at
+    is the time the weight counts from, an unbookmark takes off
+    the weight its bookmark added.
+    """
+    now = datetime.datetime.utcnow()
+    scored_at = scored_at or now
+    cocktail_id = str(cocktail["_id"])
+
+    mongo.db.cocktail_events.insert_one({
+        "cocktail_id": cocktail_id,
+        "user_id": session.get("id"),
+        "kind": kind,
+        "weight": weight,
+        "date_added": now,
+        "scored_at": scored_at
+    })
+
+    details = {
+        "alcohol": cocktail.get("alcohol"),
+        "author_id": cocktail.get("author_id")
+    }
+
+    # Logs can't be added with $inc so the score is only written
+    # if no other request has changed it since it was read
+    while True:
+        trending = mongo.db.trending.find_one(
+            {"_id": cocktail_id}, {"score": 1})
+
+        if trending is None:
+            try:
+                mongo.db.trending.insert_one(dict(
+                    details, _id=cocktail_id,
+                    score=add_to_score(NO_SCORE, weight, scored_at)))
+                return
+            except DuplicateKeyError:
+                continue
+
+        score = trending.get("score", NO_SCORE)
+        updated = mongo.db.trending.update_one(
+            {"_id": cocktail_id, "score": score},
+            {"$set": dict(
+                details, score=add_to_score(score, weight, scored_at))}
+        )
+        if updated.matched_count:
+            return
+
+
+def trending_cocktails(db, alcohol=None, limit=0, projection=None):
+    """Returns the highest scoring cocktails, optionally for
+    one alcohol. A limit of 0 returns all of them.
+    """
+    query = {"score": {"$gt": NO_SCORE}}
+    if alcohol:
+        query["alcohol"] = alcohol
+
+    scores = db.trending.find(query, {"_id": 1}).sort(
+        "score", -1).limit(limit)
+    cocktail_ids = [score["_id"] for score in scores]
+
+    cocktails = {
+        str(cocktail["_id"]): cocktail
+        for cocktail in db.cocktails.find({
+            "_id": {"$in": [ObjectId(i) for i in cocktail_ids]}
+        }, projection)
+    }
+
+    # Keep the trending order, skipping any since deleted
+    return [cocktails[i] for i in cocktail_ids if i in cocktails]
+
+
+@app.cli.command("rebuild-trending")
+def rebuild_trending():
+    """Recalculates every trending score from the event log.
+    Only needed after changing TRENDING_HALF_LIFE_HOURS or
+    TRENDING_EPOCH, or to move scores stored before they were
+    kept as logs.
+    """
+    scores = {}
+    events = mongo.db.cocktail_events.find(
+        {}, {"cocktail_id": 1, "weight": 1, "date_added": 1, "scored_at": 1}
+    ).sort("date_added", 1)
+    for event in events:
+        scores[event["cocktail_id"]] = add_to_score(
+            scores.get(event["cocktail_id"], NO_SCORE), event["weight"],
+            event.get("scored_at") or event["date_added"])
+
+    mongo.db.trending.delete_many({})
+    cocktails = mongo.db.cocktails.find(
+        {"_id": {"$in": [ObjectId(i) for i in scores]}},
+        {"alcohol": 1, "author_id": 1}
+    )
+    for cocktail in cocktails:
+        mongo.db.trending.insert_one({
+            "_id": str(cocktail["_id"]),
+            "score": scores[str(cocktail["_id"])],
+            "alcohol": cocktail.get("alcohol"),
+            "author_id": cocktail.get("author_id")
+        })
+
+    create_indexes()
+    click.echo(f"Rebuilt trending scores for {len(scores)} cocktails")
+
+
+# Background Jobs
+JOB_STATUSES = ["queued", "running", "done", "failed"]
+
+job_handlers = {}
+job_runner = {"pid": None}
+job_runner_lock = threading.Lock()
+job_wakeup = threading.Event()
+job_stats = {"run": 0, "succeeded": 0, "retried": 0, "failed": 0}
+
+
+def job_handler(kind):
+    """Registers the function that runs jobs of this kind. It is
+    called with a progress function and the job's arguments. A job
+    can run more than once (after a retry or a worker dying part way
+    through) so handlers must be safe to repeat.
+    """
+    def register(handler):
+        job_handlers[kind] = handler
+        return handler
+    return register
+
+
+def enqueue_job(kind, **args):
+    """Stores a job in the jobs collection for whichever worker's
+    runner claims it first. Returns the id /jobs/<id> reports on.
+    """
+    now = datetime.datetime.utcnow()
+    job_id = uuid.uuid4().hex
+    mongo.db.jobs.insert_one({
+        "_id": job_id,
+        "kind": kind,
+        "args": args,
+        "status": "queued",
+        "attempts": 0,
+        "progress": {"done": 0, "total": None},
+        "error": None,
+        "created": now,
+        "updated": now,
+        "run_at": now,
+    })
+
+    # Wakes this worker's runner so the job starts straight away
+    job_wakeup.set()
+    return job_id
+
+
+def claim_job():
+    """Takes the next due job, or one whose runner stopped renewing
+    its lease. find_one_and_update means only one runner gets it.
+    """
+    now = datetime.datetime.utcnow()
+    lease = datetime.timedelta(seconds=app.config["JOB_LEASE_SECONDS"])
+    return mongo.db.jobs.find_one_and_update(
+        {"$or": [
+            {"status": "queued", "run_at": {"$lte": now}},
+            {"status": "running", "locked_until": {"$lt": now}},
+        ]},
+        {
+            "$set": {
+                "status": "running",
+                "owner": WORKER_ID,
+                "locked_until": now + lease,
+                "updated": now,
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("run_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def update_job(job, fields):
+    """Updates a claimed job unless another runner has taken it over"""
+    fields["updated"] = datetime.datetime.utcnow()
+    mongo.db.jobs.update_one(
+        {"_id": job["_id"], "owner": WORKER_ID}, {"$set": fields})
+
+
+def run_job(job):
+    """Runs a claimed job. A failed job goes back in the queue,
+    waiting twice as long after each attempt, until it has been
+    tried JOB_MAX_ATTEMPTS times.
+    """
+    def progress(done, total):
+        lease = datetime.timedelta(seconds=app.config["JOB_LEASE_SECONDS"])
+        update_job(job, {
+            "progress": {"done": done, "total": total},
+            "locked_until": datetime.datetime.utcnow() + lease,
+        })
+
+    job_stats["run"] += 1
+    try:
+        handler = job_handlers.get(job["kind"])
+        if handler is None:
+            raise LookupError(f"No handler for {job['kind']} jobs")
+        handler(progress, **job["args"])
+
+    except Exception as error:
+        app.logger.exception(f"Job {job['_id']} failed")
+        now = datetime.datetime.utcnow()
+
+        if job["attempts"] < app.config["JOB_MAX_ATTEMPTS"]:
+            delay = app.config["JOB_RETRY_DELAY"] * 2 ** (job["attempts"] - 1)
+            job_stats["retried"] += 1
+            update_job(job, {
+                "status": "queued",
+                "error": str(error),
+                "run_at": now + datetime.timedelta(seconds=delay),
+            })
+        else:
+            job_stats["failed"] += 1
+            update_job(job, {
+                "status": "failed",
+                "error": str(error),
+                "expire_at": now + datetime.timedelta(
+                    seconds=app.config["JOB_RETENTION"]),
+            })
+        return
+
+    job_stats["succeeded"] += 1
+    update_job(job, {
+        "status": "done",
+        "error": None,
+        "expire_at": datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=app.config["JOB_RETENTION"]),
+    })
+
+
+def run_jobs(until_idle=False):
+    """Claims and runs jobs one at a time, waiting between polls
+    when there is nothing to do.
+    """
+    while True:
+        try:
+            job = claim_job()
+            if job:
+                run_job(job)
+                continue
+        except PyMongoError:
+            app.logger.exception("Job runner lost the database")
+
+        if until_idle:
+            return
+
+        job_wakeup.wait(app.config["JOB_POLL_INTERVAL"])
+        job_wakeup.clear()
+
+
+@app.before_request
+def start_job_runner():
+    """Starts the job runner once per worker process, in the same
+    way as the cache bus.
+    """
+    if not app.config["JOB_RUNNER_ENABLED"]:
+        return
+
+    with job_runner_lock:
+        if job_runner["pid"] == os.getpid():
+            return
+        job_runner["pid"] = os.getpid()
+
+    # Finished jobs are removed by the database once expire_at passes
+    try:
+        mongo.db.jobs.create_index(
+            [("expire_at", 1)], expireAfterSeconds=0)
+    except PyMongoError:
+        app.logger.exception("Could not create jobs expiry index")
+
+    threading.Thread(
+        target=run_jobs, name="job-runner", daemon=True
+    ).start()
+
+
+@app.cli.command("run-jobs")
+@click.option("--until-idle", is_flag=True,
+              help="Stop once there are no jobs due.")
+def run_jobs_command(until_idle):
+    """Runs background jobs in the foreground, for when
+    JOB_RUNNER_ENABLED is off in the web workers.
+    """
+    run_jobs(until_idle)
+
+
+def run_in_batches(collection, query, write, progress):
+    """Calls write with the ids of the documents matching the query
+    JOB_BATCH_SIZE at a time, reporting progress after each batch.
+    Walks the ids in order so a write that doesn't change what
+    matches can't repeat a batch.
+    """
+    total = collection.count_documents(query)
+    done = 0
+    last_id = None
+    progress(done, total)
+
+    while True:
+        batch_query = dict(query)
+        if last_id is not None:
+            batch_query["_id"] = {"$gt": last_id}
+
+        ids = [
+            doc["_id"] for doc in collection.find(batch_query, {"_id": 1})
+            .sort("_id", 1).limit(app.config["JOB_BATCH_SIZE"])
+        ]
+        if not ids:
+            break
+
+        write(ids)
+        last_id = ids[-1]
+        done = min(done + len(ids), total)
+        progress(done, total)
+
+
+@job_handler("rename_author")
+def rename_author(progress, author_id):
+    """Copies the user's username onto the cocktails they wrote.
+    The name is read when the job runs so an older rename that is
+    retried after a newer one can't put the old name back.
+    """
+    user = mongo.db.users.find_one(
+        {"_id": ObjectId(author_id)}, {"username": 1})
+
+    # The profile has been deleted, its own job removes the cocktails
+    if not user:
+        return
+
+    run_in_batches(
+        mongo.db.cocktails,
+        {"author_id": author_id, "author": {"$ne": user["username"]}},
+        lambda ids: mongo.db.cocktails.update_many(
+            {"_id": {"$in": ids}}, {"$set": {"author": user["username"]}}),
+        progress
+    )
+    broadcast_invalidation("cocktails", author_id=author_id)
+
+
+@job_handler("delete_author_cocktails")
+def delete_author_cocktails(progress, author_id):
+    """Deletes every cocktail written by a deleted user"""
+    def delete(ids):
+        cocktail_ids = [str(cocktail_id) for cocktail_id in ids]
+        mongo.db.cocktails.delete_many({"_id": {"$in": ids}})
+        mongo.db.trending.delete_many({"_id": {"$in": cocktail_ids}})
+
+        # Other users' bookmarks and ratings of these cocktails
+        for user_id in remove_cocktail_edges(cocktail_ids):
+            broadcast_invalidation("users", user_id=user_id)
+
+    run_in_batches(
+        mongo.db.cocktails, {"author_id": author_id}, delete, progress)
+    mongo.db.trending.delete_many({"author_id": author_id})
+    broadcast_invalidation("cocktails", author_id=author_id)
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    """Status and progress of a background job"""
+    job = mongo.db.jobs.find_one({"_id": job_id})
+    if not job:
+        return api_error("Job not found", 404)
+
+    return api_response({
+        "_id": job["_id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "progress": job["progress"],
+        "attempts": job["attempts"],
+        "error": job["error"],
+        "created": job["created"],
+        "updated": job["updated"],
+    })
+
+
+@metrics_source("jobs")
+def job_metrics():
+    queue = {status: 0 for status in JOB_STATUSES}
+    try:
+        for row in mongo.db.jobs.aggregate([
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+        ]):
+            queue[row["_id"]] = row["count"]
+    except PyMongoError:
+        queue = None
+
+    return {
+        "runner": job_runner["pid"] == os.getpid(),
+        "worker": job_stats,
+        "queue": queue,
+    }
+
+
+# Image Proxy
+image_cache = {"bytes": None, "hits": 0, "misses": 0, "evicted": 0}
+image_cache_lock = threading.Lock()
+image_fetch_locks = {}
+
+
+@app.template_filter("thumb")
+def thumb(url, width):
+    """Points an image at the proxy so it is sent as a thumbnail
+    of the given width. The source URL is signed so the proxy
+    only fetches images the site itself links to.
+    """
+    if not url or not app.config["IMAGE_PROXY_ENABLED"] or Image is None:
+        return url
+
+    signer = URLSafeSerializer(app.secret_key, salt="image-proxy")
+    return url_for("image_proxy", width=width, token=signer.dumps(url))
+
+
+def check_public_url(url):
+    """Raises ValueError unless the URL is http(s) on a public
+    address, image URLs are typed in by users so could point at
+    the server's own network. Returns the address that was checked
+    so the connection can be made to it.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("Only http and https images can be proxied")
+
+    if app.config["IMAGE_PROXY_ALLOW_PRIVATE"]:
+        return None
+
+    addresses = [
+        address[4][0] for address in socket.getaddrinfo(parts.hostname, None)
+    ]
+    for address in addresses:
+        if not ipaddress.ip_address(address).is_global:
+            raise ValueError("Image is on a private address")
+
+    return addresses[0]
+
+
+def pinned_connection(connection_class, address):
+    """Connection class that connects to the checked address rather
+    than looking the host up again, which a rebinding DNS server
+    could answer with a private address the second time. The Host
+    header and TLS hostname still come from the URL.
+    """
+    def connect(host, **kwargs):
+        connection = connection_class(host, **kwargs)
+        if address is not None:
+            connection._create_connection = (
+                lambda host_port, *args: socket.create_connection(
+                    (address, host_port[1]), *args))
+        return connection
+    return connect
+
+
+class PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        address = check_public_url(req.full_url)
+        return self.do_open(
+            pinned_connection(http.client.HTTPConnection, address), req)
+
+
+class PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        address = check_public_url(req.full_url)
+        return self.do_open(
+            pinned_connection(http.client.HTTPSConnection, address), req,
+            context=self._context)
+
+
+class PublicRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Checks every redirect, Google Drive links always redirect"""
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_public_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+# Every connection, redirects included, is checked and pinned
+image_opener = urllib.request.build_opener(
+    PublicHTTPHandler, PublicHTTPSHandler, PublicRedirectHandler)
+
+
+def image_cache_path(*parts):
+    """Content addressed path, the first two characters of the
+    hash are a folder so no one folder gets too big.
+    """
+    digest = hashlib.sha256("|".join(map(str, parts)).encode()).hexdigest()
+    return os.path.join(app.config["IMAGE_CACHE_DIR"], digest[:2], digest)
+
+
+def write_cache_file(path, data):
+    # Written to a temporary file first so a reader never sees half
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, "wb") as cache_file:
+        cache_file.write(data)
+    os.replace(temp_path, path)
+
+    with image_cache_lock:
+        if image_cache["bytes"] is not None:
+            image_cache["bytes"] += len(data)
+
+
+def fetch_image_source(url):
+    """Downloads the original image once, later thumbnail sizes
+    and formats are made from the cached copy.
+    """
+    path = image_cache_path("source", url)
+    if os.path.exists(path):
+        with open(path, "rb") as source_file:
+            return source_file.read()
+
+    fetch = urllib.request.Request(url, headers={"User-Agent": "Mixology"})
+    with image_opener.open(
+        fetch, timeout=app.config["IMAGE_FETCH_TIMEOUT"]
+    ) as response:
+        data = response.read(app.config["IMAGE_MAX_SOURCE_BYTES"] + 1)
+
+    if len(data) > app.config["IMAGE_MAX_SOURCE_BYTES"]:
+        raise ValueError("Image is too big")
+
+    write_cache_file(path, data)
+    return data
+
+
+def make_thumbnail(source, width, image_format):
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(source)))
+    image.thumbnail((width, width * 4))
+
+    # JPEG has no transparency
+    if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    output = io.BytesIO()
+    image.save(output, image_format, quality=80)
+    return output.getvalue()
+
+
+def evict_image_cache():
+    """Removes the least recently used files once the cache is
+    over IMAGE_CACHE_MAX_BYTES. Hits touch their file so the
+    modified time is the last time it was used.
+    """
+    limit = app.config["IMAGE_CACHE_MAX_BYTES"]
+    if image_cache["bytes"] is not None and image_cache["bytes"] <= limit:
+        return
+
+    with image_cache_lock:
+        files = []
+        for folder, _, names in os.walk(app.config["IMAGE_CACHE_DIR"]):
+            for name in names:
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+
+        # Down to 90% so it isn't evicting on every miss
+        for _, size, path in sorted(files):
+            if total <= limit * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            image_cache["evicted"] += 1
+
+        image_cache["bytes"] = total
+
+
+@app.route("/img/<int:width>/<token>")
+def image_proxy(width, token):
+    """Sends a resized copy of a cocktail or profile image. WebP
+    is sent to browsers that accept it, JPEG to the rest. If the
+    image can't be fetched or read the browser is redirected to
+    the original. Widths the site doesn't use are a 404 so the
+    proxy can't be used as a redirect to any signed URL.
+    """
+    signer = URLSafeSerializer(app.secret_key, salt="image-proxy")
+    try:
+        url = signer.loads(token)
+    except BadSignature:
+        return render_template('404.html'), 404
+
+    if width not in IMAGE_WIDTHS:
+        return render_template('404.html'), 404
+
+    if Image is None:
+        return redirect(url)
+
+    if "image/webp" in request.headers.get("Accept", ""):
+        image_format, mimetype = "WEBP", "image/webp"
+    else:
+        image_format, mimetype = "JPEG", "image/jpeg"
+
+    path = image_cache_path(url, width, image_format)
+
+    if os.path.exists(path):
+        image_cache["hits"] += 1
+        os.utime(path)
+
+    else:
+        # Only one thread makes each thumbnail
+        with image_cache_lock:
+            fetch_lock = image_fetch_locks.setdefault(path, threading.Lock())
+
+        with fetch_lock:
+            try:
+                if not os.path.exists(path):
+                    image_cache["misses"] += 1
+                    try:
+                        thumbnail = make_thumbnail(
+                            fetch_image_source(url), width, image_format)
+                    except Exception:
+                        app.logger.warning(f"Could not proxy image {url}")
+                        return redirect(url)
+
+                    write_cache_file(path, thumbnail)
+                    evict_image_cache()
+            finally:
+                image_fetch_locks.pop(path, None)
+
+    response = send_file(path, mimetype=mimetype)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    response.headers["Vary"] = "Accept"
+    return response
+
+
+@metrics_source("image_cache")
+def image_cache_metrics():
+    return {
+        "hits": image_cache["hits"],
+        "misses": image_cache["misses"],
+        "evicted": image_cache["evicted"],
+        "bytes": image_cache["bytes"],
+    }
+
+
+# Static Assets
+static_manifest = {}
+
+
+def load_static_manifest():
+    """Reads the map of asset names to fingerprinted names"""
+    try:
+        with open(app.config["STATIC_MANIFEST"]) as manifest_file:
+            static_manifest.update(json.load(manifest_file))
+    except (OSError, ValueError):
+        static_manifest.clear()
+
+
+load_static_manifest()
+
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    """Swaps url_for('static', ...) over to the fingerprinted copy
+    of a file when there is one. The name changes when the file
+    does so browsers can keep it forever.
+    """
+    if endpoint == "static" and values.get("filename") in static_manifest:
+        values["filename"] = static_manifest[values["filename"]]
+
+
+def minify_css(css):
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r" ?([{};,]) ?", r"\1", css)
+    return css.replace(";}", "}").strip()
+
+
+def minify_js(js):
+    # Only indentation, blank lines and whole line comments are removed
+    # so line breaks that end statements are kept
+    lines = (line.strip() for line in js.splitlines())
+    return "\n".join(
+        line for line in lines if line and not line.startswith("//"))
+
+
+def rebase_css_urls(css):
+    # Built files sit one folder deeper, under dist
+    return re.sub(
+        r"url\((?!['\"]?(?:https?:|data:|/|#))(['\"]?)",
+        r"url(\1../", css)
+
+
+@app.cli.command("build-assets")
+def build_assets():
+    """Minifies, fingerprints and precompresses the site's CSS
+    and JS into static/dist and writes the manifest url_for uses.
+    """
+    dist_folder = os.path.join(app.static_folder, "dist")
+    manifest = {}
+
+    for pattern in STATIC_ASSETS:
+        paths = glob.glob(os.path.join(app.static_folder, pattern))
+        for path in sorted(paths):
+            name = os.path.relpath(path, app.static_folder)
+            name = name.replace(os.sep, "/")
+            with open(path, encoding="utf-8") as asset_file:
+                content = asset_file.read()
+
+            if name.endswith(".css"):
+                content = rebase_css_urls(minify_css(content))
+            else:
+                content = minify_js(content)
+
+            data = content.encode("utf-8")
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            base, extension = os.path.splitext(name)
+            hashed_name = f"dist/{base}.{digest}{extension}"
+            hashed_path = os.path.join(app.static_folder, hashed_name)
+
+            os.makedirs(os.path.dirname(hashed_path), exist_ok=True)
+            with open(hashed_path, "wb") as hashed_file:
+                hashed_file.write(data)
+            with open(f"{hashed_path}.gz", "wb") as gzip_file:
+                gzip_file.write(gzip.compress(data, 9))
+            if brotli:
+                with open(f"{hashed_path}.br", "wb") as brotli_file:
+                    brotli_file.write(brotli.compress(data, quality=11))
+
+            manifest[name] = hashed_name
+            click.echo(f"{name} -> {hashed_name} ({len(data)} bytes)")
+
+    os.makedirs(dist_folder, exist_ok=True)
+    with open(app.config["STATIC_MANIFEST"], "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+
+    static_manifest.clear()
+    static_manifest.update(manifest)
+
+
+@app.route("/static/dist/<path:filename>")
+def static_dist(filename):
+    """Sends built assets with the precompressed copy the browser
+    accepts. The names are fingerprinted so they never change.
+    """
+    dist_folder = os.path.join(app.static_folder, "dist")
+    path = os.path.realpath(os.path.join(dist_folder, filename))
+    if not path.startswith(os.path.realpath(dist_folder) + os.sep) or (
+        not os.path.isfile(path)
+    ):
+        return render_template('404.html'), 404
+
+    accepted = request.headers.get("Accept-Encoding", "")
+    encoding = None
+    for name, extension in [("br", ".br"), ("gzip", ".gz")]:
+        if name in accepted and os.path.isfile(path + extension):
+            encoding = name
+            path += extension
+            break
+
+    response = send_file(
+        path, mimetype=mimetypes.guess_type(filename)[0], conditional=True)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+# Response Compression
+# Levels auto mode moves between, lowest to highest
+COMPRESS_LEVELS = {"br": [1, 4, 6, 8], "gzip": [1, 4, 6, 9]}
+
+compression = {
+    "level_index": {"br": 1, "gzip": 2},
+    "compressed": 0,
+    "skipped": 0,
+    "bytes_in": 0,
+    "bytes_out": 0,
+    "cpu_ms": 0.0,
+}
+compression_lock = threading.Lock()
+
+
+def compression_level(encoding):
+    if app.config["COMPRESS_LEVEL"] != "auto":
+        return int(app.config["COMPRESS_LEVEL"])
+    return COMPRESS_LEVELS[encoding][compression["level_index"][encoding]]
+
+
+def record_compression(encoding, bytes_in, bytes_out, elapsed_ms):
+    """Keeps the totals and in auto mode steps the level down when
+    a response went over the CPU budget and up when it came in
+    well under, so the level follows the size of the pages.
+    """
+    budget = app.config["COMPRESS_CPU_BUDGET_MS"]
+    with compression_lock:
+        compression["compressed"] += 1
+        compression["bytes_in"] += bytes_in
+        compression["bytes_out"] += bytes_out
+        compression["cpu_ms"] += elapsed_ms
+
+        index = compression["level_index"][encoding]
+        if elapsed_ms > budget and index > 0:
+            compression["level_index"][encoding] = index - 1
+        elif elapsed_ms < budget / 4 and (
+            index < len(COMPRESS_LEVELS[encoding]) - 1
+        ):
+            compression["level_index"][encoding] = index + 1
+
+
+def compressor(encoding, level):
+    """Returns compress and finish functions for the encoding"""
+    if encoding == "br":
+        brotli_compressor = brotli.Compressor(quality=level)
+        return (
+            lambda data: brotli_compressor.process(data) +
+            brotli_compressor.flush(),
+            brotli_compressor.finish
+        )
+
+    # wbits 31 writes a gzip header rather than raw zlib
+    gzip_compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return (
+        lambda data: gzip_compressor.compress(data) +
+        gzip_compressor.flush(zlib.Z_SYNC_FLUSH),
+        gzip_compressor.flush
+    )
+
+
+def compress_stream(chunks, encoding, level):
+    """Compresses a streamed page chunk by chunk, flushing each one
+    so the browser still gets the header straight away.
+    """
+    compress, finish = compressor(encoding, level)
+    bytes_in = bytes_out = 0
+    elapsed = 0.0
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            started = time.perf_counter()
+            data = compress(chunk)
+            elapsed += time.perf_counter() - started
+            bytes_in += len(chunk)
+            bytes_out += len(data)
+            if data:
+                yield data
+
+        data = finish()
+        bytes_out += len(data)
+        yield data
+        record_compression(encoding, bytes_in, bytes_out, elapsed * 1000)
+
+    # Closes the page stream too if the browser goes away
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+@app.after_request
+def compress_response(response):
+    """Gzip or brotli compresses text responses for browsers that
+    accept it. Files sent straight from disk, responses that are
+    already encoded and ones under COMPRESS_MIN_SIZE are left.
+    """
+    if not app.config["COMPRESS_ENABLED"]:
+        return response
+
+    if (
+        response.status_code < 200 or
+        response.status_code in (204, 304) or
+        response.direct_passthrough or
+        "Content-Encoding" in response.headers or
+        response.mimetype not in app.config["COMPRESS_MIMETYPES"]
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    if brotli and request.accept_encodings["br"]:
+        encoding = "br"
+    elif request.accept_encodings["gzip"]:
+        encoding = "gzip"
+    else:
+        return response
+
+    level = compression_level(encoding)
+
+    if response.is_streamed:
+        response.response = compress_stream(
+            response.response, encoding, level)
+        response.headers.pop("Content-Length", None)
+
+    else:
+        data = response.get_data()
+        if len(data) < app.config["COMPRESS_MIN_SIZE"]:
+            with compression_lock:
+                compression["skipped"] += 1
+            return response
+
+        started = time.perf_counter()
+        compress, finish = compressor(encoding, level)
+        compressed = compress(data) + finish()
+        record_compression(
+            encoding, len(data), len(compressed),
+            (time.perf_counter() - started) * 1000)
+        response.set_data(compressed)
+
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+@metrics_source("compression")
+def compression_metrics():
+    with compression_lock:
+        totals = {
+            key: value for key, value in compression.items()
+            if key != "level_index"
+        }
+    totals["levels"] = {
+        encoding: compression_level(encoding) for encoding in COMPRESS_LEVELS
+    }
+    totals["ratio"] = (
+        totals["bytes_out"] / totals["bytes_in"]
+        if totals["bytes_in"] else None)
+    return totals
+
+
+# JSON API
+# Fields a client can ask for, cards get the short list by default
+API_CARD_FIELDS = [
+    "cocktail_name", "alcohol", "image", "rating", "no_rating",
+    "no_of_bookmarks", "author", "author_id", "date_added"
+]
+API_RECIPE_FIELDS = API_CARD_FIELDS + [
+    "ingredients", "garnish", "tools", "glass", "instructions"
+]
+API_PAGE_SIZE = 20
+API_MAX_PAGE_SIZE = 100
+
+
+def api_default(value):
+    """Serialises the bson types json doesn't know about as the
+    encoder reaches them, so documents aren't copied first.
+    """
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat() + "Z"
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+api_encoder = json.JSONEncoder(default=api_default, separators=(",", ":"))
+
+
+def api_response(data, status=200):
+    return Response(
+        api_encoder.encode(data), status=status, mimetype="application/json")
+
+
+def api_error(message, status):
+    return api_response({"error": message}, status)
+
+
+def api_projection(allowed, default):
+    """Builds the projection from the comma separated fields
+    parameter. Returns None if an unknown field is asked for.
+    """
+    fields = request.args.get("fields")
+    if not fields:
+        return {field: 1 for field in default}
+
+    fields = fields.split(",")
+    if any(field not in allowed for field in fields):
+        return None
+    return {field: 1 for field in fields}
+
+
+def api_wants_ndjson():
+    return (
+        request.args.get("format") == "ndjson" or
+        request.accept_mimetypes.best == "application/x-ndjson"
+    )
+
+
+def api_list(query, projection):
+    """Pages through cocktails newest first. The cursor is the
+    last _id of the previous page so later pages don't skip
+    over earlier ones. NDJSON streams every match straight from
+    the Mongo cursor one line at a time.
+    """
+    cursor_id = request.args.get("cursor")
+    if cursor_id:
+        try:
+            query["_id"] = {"$lt": ObjectId(cursor_id)}
+        except InvalidId:
+            return api_error("Invalid cursor", 400)
+
+    cocktails = read_db().cocktails.find(query, projection).sort("_id", -1)
+
+    if api_wants_ndjson():
+        def generate():
+            for cocktail in cocktails.batch_size(API_MAX_PAGE_SIZE):
+                yield api_encoder.encode(cocktail) + "\n"
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype="application/x-ndjson"
+        )
+
+    try:
+        limit = min(int(request.args.get("limit", API_PAGE_SIZE)),
+                    API_MAX_PAGE_SIZE)
+    except ValueError:
+        return api_error("Invalid limit", 400)
+    if limit < 1:
+        return api_error("Invalid limit", 400)
+
+    page = list(cocktails.limit(limit))
+    return api_response({
+        "cocktails": page,
+        "next_cursor": page[-1]["_id"] if len(page) == limit else None
+    })
+
+
+@app.route("/api/cocktails")
+def api_cocktails():
+    """Cocktail cards, optionally filtered by alcohol or author"""
+    projection = api_projection(API_RECIPE_FIELDS, API_CARD_FIELDS)
+    if projection is None:
+        return api_error("Unknown field", 400)
+
+    query = {}
+    if request.args.get("alcohol"):
+        query["alcohol"] = request.args.get("alcohol").lower()
+    if request.args.get("author_id"):
+        query["author_id"] = request.args.get("author_id")
+
+    return api_list(query, projection)
+
+
+@app.route("/api/cocktails/<cocktail_id>")
+def api_cocktail(cocktail_id):
+    """A full cocktail recipe"""
+    projection = api_projection(API_RECIPE_FIELDS, API_RECIPE_FIELDS)
+    if projection is None:
+        return api_error("Unknown field", 400)
+
+    try:
+        cocktail = get_cocktail(cocktail_id)
+    except InvalidId:
+        cocktail = None
+
+    if not cocktail:
+        return api_error("Cocktail not found", 404)
+
+    # The cached document is whole so the fields are picked out here
+    return api_response({
+        field: value for field, value in cocktail.items()
+        if field == "_id" or field in projection
+    })
+
+
+@app.route("/api/rails", defaults={"alcohol_name": None})
+@app.route("/api/rails/<alcohol_name>")
+def api_rails(alcohol_name):
+    """The home page rails, for all cocktails or one alcohol"""
+    projection = api_projection(API_RECIPE_FIELDS, API_CARD_FIELDS)
+    if projection is None:
+        return api_error("Unknown field", 400)
+
+    return api_response({
+        "rails": get_rails(read_db(), alcohol_name, projection)
+    })
+
+
+@app.route("/api/search")
+def api_search():
+    """Cocktails matching the q text search"""
+    projection = api_projection(API_RECIPE_FIELDS, API_CARD_FIELDS)
+    if projection is None:
+        return api_error("Unknown field", 400)
+
+    query = request.args.get("q", "").strip().lower()
+    if not query:
+        return api_error("Empty search", 400)
+
+    return api_list({"$text": {"$search": query}}, projection)
+
+
+# Import / Export
+TRANSFER_COLLECTIONS = [
+    "cocktails", "users", "user_cocktails"] + REFERENCE_COLLECTIONS
+
+
+def normalise_cocktail(doc):
+    """Checks and formates an imported cocktail the same way the
+    cocktail form does. Raises ValueError if it can't be stored.
+    """
+    for key in ["cocktail_name", "alcohol", "author", "author_id", "glass"]:
+        if not isinstance(doc.get(key), str) or not doc[key]:
+            raise ValueError(f"{key} is required")
+
+    doc["cocktail_name"] = doc["cocktail_name"].lower()
+    doc["alcohol"] = doc["alcohol"].lower()
+    doc["glass"] = doc["glass"].lower()
+
+    alcohols = [
+        alcohol["alcohol_name"].lower()
+        for alcohol in get_reference("alcohol")
+    ]
+    if doc["alcohol"] not in alcohols:
+        raise ValueError(f"unknown alcohol {doc['alcohol']}")
+
+    for key, item in [
+        ("ingredients", "ingredient"),
+        ("garnish", "garnish"),
+        ("tools", "tool"),
+        ("instructions", "instruction")
+    ]:
+        doc[key] = normalise_items(item, doc.get(key) or [])
+
+    if not all(isinstance(step, str) for step in (
+        doc["tools"] + doc["instructions"]
+    )):
+        raise ValueError("tools and instructions must be text")
+
+    # Same starting values as a cocktail added through the form
+    doc.setdefault("image", "")
+    doc.setdefault("date_added", datetime.datetime.utcnow())
+    for key in ["rating", "no_rating", "no_of_bookmarks", "rating_sum"]:
+        doc.setdefault(key, 0)
+
+    return doc
+
+
+def normalise_user(doc):
+    """Checks and formates an imported user. Passwords must
+    already be hashed, plain text passwords are refused.
+    """
+    if not isinstance(doc.get("username"), str) or not doc["username"]:
+        raise ValueError("username is required")
+    if "$" not in str(doc.get("password", "")):
+        raise ValueError("password must be a werkzeug hash")
+
+    doc["username"] = doc["username"].lower()
+    doc.setdefault("image", "")
+    doc.setdefault("date_added", datetime.datetime.utcnow())
+    return doc
+
+
+def normalise_edge(doc):
+    """Checks an imported bookmark or rating"""
+    for key in ["user_id", "cocktail_id"]:
+        if not isinstance(doc.get(key), str) or not doc[key]:
+            raise ValueError(f"{key} is required")
+    if doc.get("kind") not in EDGE_KINDS.values():
+        raise ValueError("kind must be bookmark or rating")
+
+    doc.setdefault("date_added", datetime.datetime.utcnow())
+    return doc
+
+
+NORMALISERS = {
+    "cocktails": normalise_cocktail,
+    "users": normalise_user,
+    "user_cocktails": normalise_edge,
+}
+
+
+@app.cli.command("export")
+@click.argument("collection", type=click.Choice(TRANSFER_COLLECTIONS))
+@click.argument("output", type=click.File("w"))
+@click.option("--query", default="{}", help="Extended JSON filter")
+def export_collection(collection, output, query):
+    """Writes a collection out as NDJSON, one extended JSON
+    document per line so ObjectIds and dates survive the trip.
+    Use - as the output to write to stdout.
+    """
+    count = 0
+    cursor = mongo.db[collection].find(json_util.loads(query))
+    for doc in cursor.batch_size(1000):
+        output.write(json_util.dumps(doc) + "\n")
+        count += 1
+        if count % 10000 == 0:
+            click.echo(f"{count} exported", err=True)
+
+    click.echo(f"{count} {collection} exported", err=True)
+
+
+@app.cli.command("import")
+@click.argument("collection", type=click.Choice(TRANSFER_COLLECTIONS))
+@click.argument("source", type=click.Path(exists=True, dir_okay=False))
+@click.option("--batch-size", default=500, show_default=True)
+@click.option(
+    "--ordered/--unordered", default=True, show_default=True,
+    help="Ordered batches stop at the first failed write")
+@click.option(
+    "--resume/--restart", default=True, show_default=True,
+    help="Carry on from the last batch of an interrupted import")
+def import_collection(collection, source, batch_size, ordered, resume):
+    """Loads NDJSON into a collection in bulk writes. Documents
+    go through the same checks as the site forms and replace any
+    existing copy, so rerunning is safe. The last written
+    position is kept in SOURCE.progress so an interrupted import
+    can pick up where it stopped.
+    """
+    create_indexes()
+    normalise = NORMALISERS.get(collection, lambda doc: doc)
+    checkpoint_path = f"{source}.progress"
+    source_name = os.path.basename(source).encode()
+    total_size = os.path.getsize(source) or 1
+
+    checkpoint = {"offset": 0, "line": 0, "written": 0, "skipped": 0}
+    if resume and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        click.echo(f"Resuming from line {checkpoint['line']}", err=True)
+
+    def write_batch(operations, offset, line):
+        try:
+            result = mongo.db[collection].bulk_write(
+                operations, ordered=ordered)
+            checkpoint["written"] += (
+                result.inserted_count + result.upserted_count +
+                result.matched_count)
+        except BulkWriteError as e:
+            checkpoint["written"] += (
+                e.details["nInserted"] + e.details["nUpserted"] +
+                e.details["nMatched"])
+            checkpoint["skipped"] += len(e.details["writeErrors"])
+            for error in e.details["writeErrors"][:3]:
+                click.echo(f"Write error: {error['errmsg']}", err=True)
+            if ordered:
+                raise click.ClickException(
+                    "Stopped at a failed write, fix it and run again")
+
+        # Only saved once the batch is in the database
+        checkpoint["offset"] = offset
+        checkpoint["line"] = line
+        with open(checkpoint_path, "w") as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+
+        click.echo(
+            f"{checkpoint['written']} written, {checkpoint['skipped']} "
+            f"skipped ({offset * 100 // total_size}%)", err=True)
+
+    with open(source, "rb") as source_file:
+        source_file.seek(checkpoint["offset"])
+        line = checkpoint["line"]
+        operations = []
+
+        for raw_line in iter(source_file.readline, b""):
+            line += 1
+            if not raw_line.strip():
+                continue
+
+            try:
+                doc = normalise(json_util.loads(raw_line.decode("utf-8")))
+            except ValueError as e:
+                checkpoint["skipped"] += 1
+                click.echo(f"Line {line} skipped: {e}", err=True)
+                continue
+
+            # Lines without an _id get one from where they are in the
+            # file, so a batch written again after a crash replaces
+            # its first copy rather than adding a duplicate
+            if "_id" not in doc:
+                offset = source_file.tell() - len(raw_line)
+                doc["_id"] = ObjectId(hashlib.blake2b(
+                    b"%s:%d:%s" % (source_name, offset, raw_line),
+                    digest_size=12).digest())
+
+            operations.append(
+                ReplaceOne({"_id": doc["_id"]}, doc, upsert=True))
+
+            if len(operations) >= batch_size:
+                write_batch(operations, source_file.tell(), line)
+                operations = []
+
+        if operations:
+            write_batch(operations, source_file.tell(), line)
+
+    # Finished so the next import starts from the top
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    # Every worker's caches may now be out of date
+    broadcast_invalidation("*")
+    click.echo(
+        f"{checkpoint['written']} {collection} imported, "
+        f"{checkpoint['skipped']} skipped", err=True)
+
+
+# Startup Warmup
+# Templates compiled on one start are loaded as bytecode on the next
+os.makedirs(app.config["TEMPLATE_CACHE_DIR"], exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+    app.config["TEMPLATE_CACHE_DIR"])
+
+warmup = {"pid": None, "state": "cold", "error": None, "steps": {}}
+warmup_lock = threading.Lock()
+
+
+def warm_templates():
+    for template_name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template_name)
+
+
+def open_pool():
+    """Pings the database on as many connections as the pool keeps
+    open so the first requests don't wait for them to connect.
+    """
+    size = app.config.get("MONGO_MIN_POOL_SIZE") or 1
+    with ThreadPoolExecutor(size) as executor:
+        list(executor.map(
+            lambda _: mongo.cx.admin.command("ping"), range(size)))
+
+
+def warm_caches():
+    for collection in REFERENCE_COLLECTIONS:
+        get_reference(collection)
+
+
+def warm_home_rails():
+    get_home_rails()
+    for alcohol in get_reference("alcohol"):
+        get_home_rails(alcohol["alcohol_name"])
+
+
+WARMUP_STEPS = [
+    ("templates", warm_templates),
+    ("mongo_pool", open_pool),
+    ("reference_data", warm_caches),
+    ("home_rails", warm_home_rails),
+]
+
+
+def warm_up():
+    """Runs each warmup step, timing them for /ready. A failed
+    warmup is tried again by the next request.
+    """
+    try:
+        for name, step in WARMUP_STEPS:
+            started = time.monotonic()
+            step()
+            warmup["steps"][name] = round(
+                (time.monotonic() - started) * 1000, 1)
+    except Exception as error:
+        app.logger.exception("Warmup failed")
+        warmup.update(state="failed", error=str(error), pid=None)
+        return
+
+    warmup["state"] = "ready"
+
+
+@app.before_request
+def start_warmup():
+    """Warms the worker up in the background once per process.
+    Called as the server starts, and by the first request where
+    the server didn't or the last warmup failed. Until it is
+    done /ready tells the load balancer to wait.
+    """
+    if not app.config["WARMUP_ENABLED"]:
+        return
+
+    with warmup_lock:
+        if warmup["pid"] == os.getpid():
+            return
+        warmup.update(pid=os.getpid(), state="warming", error=None, steps={})
+
+    threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+
+
+@app.route("/ready")
+def ready():
+    """Readiness check, 503 until this worker has warmed up"""
+    is_ready = (
+        warmup["state"] == "ready" or not app.config["WARMUP_ENABLED"])
+    return jsonify(
+        ready=is_ready,
+        state=warmup["state"],
+        steps=warmup["steps"],
+        error=warmup["error"]
+    ), 200 if is_ready else 503
+
+
+@metrics_source("warmup")
+def warmup_metrics():
+    return {
+        "state": warmup["state"],
+        "steps_ms": warmup["steps"],
+        "home_rails_cached": len(home_rails_cache),
+    }
+
+
+# Admission Control
+class AdmissionGate:
+    """Lets at most limit requests into a route at once. The rest
+    wait in a queue, form posts first then signed in users then
+    everyone else, each giving up when its deadline passes. Once
+    max_queue are waiting new requests are turned away at once.
+    """
+    def __init__(self, limit, max_queue):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+        self.waiters = []
+        self.arrivals = 0
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,
+            "timed_out": 0,
+            "shed": 0,
+            "served_stale": 0,
+            "queue_ms_total": 0.0,
+            "queue_ms_max": 0.0,
+        }
+
+    def acquire(self, priority, timeout):
+        with self.lock:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                self.stats["admitted"] += 1
+                return True
+
+            if self.waiting >= self.max_queue:
+                self.stats["shed"] += 1
+                return False
+
+            waiter = {"event": threading.Event(), "admitted": False}
+            self.arrivals += 1
+            heapq.heappush(self.waiters, (priority, self.arrivals, waiter))
+            self.waiting += 1
+            self.stats["queued"] += 1
+
+        started = time.monotonic()
+        waiter["event"].wait(timeout)
+        waited = (time.monotonic() - started) * 1000
+
+        with self.lock:
+            self.stats["queue_ms_total"] += waited
+            self.stats["queue_ms_max"] = max(
+                self.stats["queue_ms_max"], waited)
+
+            if waiter["admitted"]:
+                self.stats["admitted"] += 1
+                return True
+
+            # Left in the heap, release skips it
+            waiter["cancelled"] = True
+            self.waiting -= 1
+            self.stats["timed_out"] += 1
+            return False
+
+    def release(self):
+        """Hands the slot to the first waiter still in the queue"""
+        with self.lock:
+            while self.waiters:
+                waiter = heapq.heappop(self.waiters)[2]
+                if not waiter.get("cancelled"):
+                    waiter["admitted"] = True
+                    self.waiting -= 1
+                    waiter["event"].set()
+                    return
+
+            self.active -= 1
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats, limit=self.limit, active=self.active,
+                         waiting=self.waiting)
+        stats["queue_ms_average"] = (
+            stats["queue_ms_total"] / stats["queued"]
+            if stats["queued"] else 0.0)
+        return stats
+
+
+admission_gates = {
+    endpoint: AdmissionGate(limit, app.config["ADMISSION_MAX_QUEUE"])
+    for endpoint, limit in app.config["ADMISSION_LIMITS"].items()
+    if limit > 0
+}
+
+# Last good copy of each gated page, served when a request is shed
+stale_pages = OrderedDict()
+stale_pages_lock = threading.Lock()
+
+
+def store_stale_page(key, body):
+    with stale_pages_lock:
+        stale_pages[key] = {"body": body, "stored": time.time()}
+        stale_pages.move_to_end(key)
+        while len(stale_pages) > app.config["ADMISSION_STALE_PAGES"]:
+            stale_pages.popitem(last=False)
+
+
+def capture_page(chunks, key):
+    """Passes a streamed page on, keeping a copy once it has all
+    been sent. A page cut short isn't kept.
+    """
+    body = []
+    try:
+        for chunk in chunks:
+            body.append(
+                chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+            yield chunk
+        store_stale_page(key, b"".join(body))
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def shed_response(gate):
+    """The page as it was last rendered for a signed out visitor
+    if there is a recent enough copy, otherwise a quick 503.
+    """
+    # The copy has none of a signed in user's own state on it
+    page = None
+    if request.method == "GET" and not session.get("user"):
+        page = stale_pages.get(request.full_path)
+
+    if page:
+        age = time.time() - page["stored"]
+        if age < app.config["ADMISSION_STALE_SECONDS"]:
+            gate.stats["served_stale"] += 1
+            response = Response(page["body"], mimetype="text/html")
+            response.headers["Age"] = str(int(age))
+            return response
+
+    response = Response(
+        render_template("503.html"), status=503, mimetype="text/html")
+    response.headers["Retry-After"] = str(app.config["ADMISSION_RETRY_AFTER"])
+    return response
+
+
+@app.before_request
+def admit_request():
+    """Holds requests to the expensive routes until there is room
+    for them, or sheds them once the queue is full or their
+    deadline passes.
+    """
+    gate = admission_gates.get(request.endpoint)
+    if gate is None:
+        return
+
+    if request.method == "POST":
+        priority = 0
+    elif session.get("user"):
+        priority = 1
+    else:
+        priority = 2
+
+    timeout = app.config["ADMISSION_QUEUE_TIMEOUT_MS"] / 1000
+    if not gate.acquire(priority, timeout):
+        return shed_response(gate)
+
+    g.admission_gate = gate
+
+    # Only pages that are the same for every signed out visitor are kept
+    if (
+        request.method == "GET" and
+        not session.get("user") and
+        "_flashes" not in session
+    ):
+        g.stale_page_key = request.full_path
+
+
+@app.after_request
+def keep_stale_page(response):
+    key = g.pop("stale_page_key", None)
+    if key is None or response.status_code != 200 or (
+        response.direct_passthrough
+    ):
+        return response
+
+    if response.is_streamed:
+        response.response = capture_page(response.response, key)
+    else:
+        store_stale_page(key, response.get_data())
+    return response
+
+
+@app.teardown_request
+def release_admission(error):
+    """Streamed pages read from the database as they are sent so
+    the slot is only given back once the response is finished.
+    """
+    gate = g.pop("admission_gate", None)
+    if gate is not None:
+        gate.release()
+
 
-            # Update datebase
-            mongo.db.cocktails.update_one(cocktail_query, cocktail_update)
-            mongo.db.users.update_one(user_query, user_update)
+@metrics_source("admission")
+def admission_metrics():
+    return {
+        endpoint: gate.snapshot()
+        for endpoint, gate in admission_gates.items()
+    }
 
 
 # Error Handler 404 Page Not Found
@@ -1103,6 +4339,9 @@ def page_not_found(e):
 
 
 if __name__ == "__main__":
+    # Warms up while the server starts rather than on the first
+    # request, CLI commands and hash pool processes never get here
+    start_warmup()
     app.run(
         host=os.environ.get("IP"),
         port=int(os.environ.get("PORT")),
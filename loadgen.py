@@ -0,0 +1,505 @@
+"""Mixology load generator
+
+Replays user journeys against a running instance of the site to
+find how many users one worker can hold. Readers browse the home
+page, filter by spirit, open a cocktail, bookmark or rate it and
+look at a profile. Creators add cocktails through the create form.
+
+Closed loop runs a fixed number of users who each start their next
+journey after a think time. Open loop starts journeys at a Poisson
+rate whether or not earlier ones have finished, which is how real
+traffic arrives and shows queueing once the site saturates.
+
+Run against a local instance only, it registers loadgen users and
+adds cocktails. e.g.
+
+    python loadgen.py closed --users 1,2,4,8,16 --duration 30
+    python loadgen.py open --rates 1,2,4,8 --csv curve.csv
+"""
+import csv
+import gzip
+import http.cookiejar
+import math
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+import click
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+ALCOHOL_LINK = re.compile(r'href="(/home/[^"/]+)"')
+COCKTAIL_LINK = re.compile(r'href="(/cocktail/[^"/]+/[0-9a-f]{24})"')
+PROFILE_LINK = re.compile(r'href="(/profile/[^"/]+/[0-9a-f]{24})"')
+FORM_TOKEN = re.compile(r'name="random" value="([^"]+)"')
+RATING_FORM = re.compile(r'name="star-rating"')
+
+LIST_PAGES = ["/view-all/trending", "/view-all/top-rated",
+              "/view-all/newly-added", "/view-all/most-popular"]
+SEARCH_TERMS = ["gin", "sour", "lime", "mint", "rum", "fizz"]
+
+
+# Recording
+class Recorder:
+    """Collects one record per request: the route, status, time
+    taken and the bytes sent over the wire and after decoding.
+    Only requests started between the end of the level's ramp up
+    and the end of its run are kept, so the backlog that drains
+    afterwards isn't counted as throughput.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+        self.journeys = 0
+        self.dropped = 0
+        self.since = math.inf
+        self.until = math.inf
+
+    def start(self, ramp, duration):
+        with self.lock:
+            self.records = []
+            self.journeys = 0
+            self.dropped = 0
+            now = time.monotonic()
+            self.since = now + ramp
+            self.until = now + duration
+
+    def counts(self, started):
+        return self.since <= started < self.until
+
+    def add(self, route, status, started, elapsed_ms, wire, body):
+        if not self.counts(started):
+            return
+        with self.lock:
+            self.records.append((route, status, elapsed_ms, wire, body))
+
+    def journey(self, started):
+        if self.counts(started):
+            with self.lock:
+                self.journeys += 1
+
+    def drop(self):
+        with self.lock:
+            self.dropped += 1
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(
+        fraction * len(values))) - 1)]
+
+
+def summarise(records, seconds):
+    latencies = [record[2] for record in records]
+    errors = sum(1 for record in records if record[1] == 0 or (
+        record[1] >= 400 and record[1] != 503))
+    shed = sum(1 for record in records if record[1] == 503)
+    wire = sum(record[3] for record in records)
+    body = sum(record[4] for record in records)
+    count = len(records) or 1
+    return {
+        "requests": len(records),
+        "rps": len(records) / seconds,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "error_pct": errors * 100 / count,
+        "shed_pct": shed * 100 / count,
+        "wire_kb": wire / count / 1024,
+        "compression": body / wire if wire else 1.0,
+    }
+
+
+# Client
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Redirects are followed by hand so each hop is timed
+    def redirect_request(self, *args):
+        return None
+
+
+class Client:
+    """One browser: a cookie jar for its session and the encodings
+    it accepts. Every request made is passed to the recorder.
+    """
+    def __init__(self, base_url, recorder, encoding, timeout):
+        self.base_url = base_url.rstrip("/")
+        self.recorder = recorder
+        self.encoding = encoding
+        self.timeout = timeout
+        self.username = None
+        self.profile = None
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            NoRedirect
+        )
+
+    def request(self, path, form=None):
+        """Sends the request, following any redirects, and returns
+        the decoded page of the last one.
+        """
+        while True:
+            data = urllib.parse.urlencode(form).encode() if form else None
+            request = urllib.request.Request(self.base_url + path, data)
+            if self.encoding != "identity":
+                request.add_header("Accept-Encoding", self.encoding)
+
+            route = "/" + path.lstrip("/").split("/")[0]
+            started = time.monotonic()
+            try:
+                with self.opener.open(request, timeout=self.timeout) as reply:
+                    status = reply.status
+                    raw = reply.read()
+                    headers = reply.headers
+            except urllib.error.HTTPError as error:
+                status = error.code
+                raw = error.read()
+                headers = error.headers
+            except OSError:
+                self.recorder.add(
+                    route, 0, started,
+                    (time.monotonic() - started) * 1000, 0, 0)
+                return ""
+
+            page = decode(raw, headers.get("Content-Encoding"))
+            self.recorder.add(
+                route, status, started, (time.monotonic() - started) * 1000,
+                len(raw), len(page))
+
+            if status in (301, 302, 303, 307, 308) and headers["Location"]:
+                location = urllib.parse.urlsplit(headers["Location"])
+                path = location.path + (
+                    "?" + location.query if location.query else "")
+                if status in (301, 302, 303):
+                    form = None
+                continue
+
+            return page.decode("utf-8", "replace")
+
+
+def decode(raw, encoding):
+    if encoding == "gzip":
+        return gzip.decompress(raw)
+    if encoding == "br":
+        return brotli.decompress(raw)
+    return raw
+
+
+# Journeys
+def sign_up(client, password):
+    """Registers a new loadgen user, the session stays logged in"""
+    client.username = f"loadgen-{uuid.uuid4().hex[:10]}"
+    page = client.request("/register", {
+        "reg-username": client.username,
+        "reg-password": password,
+    })
+    links = PROFILE_LINK.findall(page)
+    client.profile = next((
+        link for link in links if f"/{client.username}/" in link), None)
+    if not client.profile:
+        raise click.ClickException(
+            f"Could not register {client.username}, is the site up?")
+
+
+def reader_journey(client, list_page_chance):
+    """home, a spirit, a cocktail, a bookmark or rating, a profile"""
+    page = client.request("/home")
+
+    alcohols = ALCOHOL_LINK.findall(page)
+    if alcohols:
+        page = client.request(random.choice(alcohols))
+
+    cocktails = COCKTAIL_LINK.findall(page)
+    if not cocktails:
+        return
+    cocktail_path = random.choice(cocktails)
+    page = client.request(cocktail_path)
+
+    if client.username:
+        token = FORM_TOKEN.search(page)
+        form = {
+            "cocktail-id": cocktail_path.rsplit("/", 1)[1],
+            "random": token.group(1) if token else uuid.uuid4().hex,
+        }
+        if RATING_FORM.search(page) and random.random() < 0.5:
+            form["form-submit"] = "rating"
+            form["star-rating"] = random.randint(1, 5)
+        else:
+            form["form-submit"] = "bookmark"
+        page = client.request(cocktail_path, form)
+
+    # Their own profile, or the author's for a signed out reader
+    if client.profile:
+        client.request(client.profile)
+    else:
+        profiles = PROFILE_LINK.findall(page)
+        if profiles:
+            client.request(random.choice(profiles))
+
+    if random.random() < list_page_chance:
+        if random.random() < 0.5:
+            client.request(random.choice(LIST_PAGES))
+        else:
+            client.request(f"/search/{random.choice(SEARCH_TERMS)}")
+
+
+def creator_journey(client):
+    """Opens the create form and adds a cocktail"""
+    page = client.request("/cocktail-create")
+    token = FORM_TOKEN.search(page)
+    client.request("/cocktail-create", {
+        "random": token.group(1) if token else uuid.uuid4().hex,
+        "cocktail-name": f"loadgen {uuid.uuid4().hex[:8]}",
+        "alcohol": random.choice(["vodka", "whiskey", "gin", "rum",
+                                  "tequila"]),
+        "cocktail-img-url": "",
+        "glass": "coupe",
+        "no-of-ingred": 2,
+        "ingredient-amount-1": 50,
+        "ingredient-unit-1": "ml",
+        "ingredient-name-1": "spirit",
+        "ingredient-amount-2": 25,
+        "ingredient-unit-2": "ml",
+        "ingredient-name-2": "lime juice",
+        "no-of-garnish": 1,
+        "garnish-amount-1": 1,
+        "garnish-name-1": "lime wheel",
+        "no-of-tools": 1,
+        "tool-1": "shaker",
+        "no-of-instr": 2,
+        "instruction-1": "Shake with ice",
+        "instruction-2": "Strain into a chilled glass",
+    })
+
+
+def run_journey(client, options):
+    started = time.monotonic()
+    if client.username and random.random() < options["creators"]:
+        creator_journey(client)
+    else:
+        reader_journey(client, options["list_pages"])
+    options["recorder"].journey(started)
+
+
+# Arrival Models
+def closed_loop(clients, duration, options):
+    """Each client runs journeys back to back with an exponential
+    think time in between, so load stays at len(clients) users.
+    """
+    stop = threading.Event()
+
+    def user(client):
+        while not stop.is_set():
+            run_journey(client, options)
+            stop.wait(random.expovariate(1000 / options["think_ms"])
+                      if options["think_ms"] else 0)
+
+    threads = [
+        threading.Thread(target=user, args=(client,), daemon=True)
+        for client in clients
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+
+def open_loop(clients, rate, duration, options):
+    """Starts journeys at a Poisson rate per second on a random
+    client. Journeys over max_inflight are dropped and counted.
+    """
+    inflight = threading.BoundedSemaphore(options["max_inflight"])
+    threads = []
+
+    def journey(client):
+        try:
+            run_journey(client, options)
+        finally:
+            inflight.release()
+
+    end = time.monotonic() + duration
+    next_arrival = time.monotonic()
+    while True:
+        next_arrival += random.expovariate(rate)
+        if next_arrival >= end:
+            break
+        time.sleep(max(0, next_arrival - time.monotonic()))
+
+        if not inflight.acquire(blocking=False):
+            options["recorder"].drop()
+            continue
+        thread = threading.Thread(
+            target=journey, args=(random.choice(clients),), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+
+# Command Line
+def parse_levels(value):
+    return [float(level) for level in value.split(",") if level]
+
+
+def make_clients(count, options):
+    """count browsers, the signed_in share of them with accounts"""
+    password = uuid.uuid4().hex
+    clients = []
+    for number in range(count):
+        client = Client(options["url"], options["recorder"],
+                        options["encoding"], options["timeout"])
+        if number < round(count * options["signed_in"]):
+            sign_up(client, password)
+        clients.append(client)
+    return clients
+
+
+def report(model, level, options):
+    """Prints a line of the curve and adds rows for every route
+    to the CSV rows.
+    """
+    recorder = options["recorder"]
+    seconds = options["duration"] - options["ramp"]
+    summary = summarise(recorder.records, seconds)
+    click.echo(
+        f"{model:6} {level:>7g} {recorder.journeys / seconds:>9.2f} "
+        f"{summary['rps']:>8.2f} {summary['p50_ms']:>8.1f} "
+        f"{summary['p95_ms']:>8.1f} {summary['p99_ms']:>8.1f} "
+        f"{summary['error_pct']:>6.1f} {summary['shed_pct']:>6.1f} "
+        f"{recorder.dropped:>7} {summary['wire_kb']:>8.1f} "
+        f"{summary['compression']:>6.1f}x"
+    )
+
+    routes = sorted({record[0] for record in recorder.records})
+    for route in ["all"] + routes:
+        records = [
+            record for record in recorder.records
+            if route == "all" or record[0] == route
+        ]
+        options["rows"].append(dict(
+            summarise(records, seconds),
+            model=model, level=level, route=route,
+            journeys_per_second=recorder.journeys / seconds,
+            dropped=recorder.dropped,
+        ))
+
+
+def run_levels(model, levels, options):
+    click.echo(
+        f"{'model':6} {'level':>7} {'journey/s':>9} {'req/s':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'err%':>6} "
+        f"{'503%':>6} {'dropped':>7} {'KB/req':>8} {'ratio':>7}")
+
+    clients = []
+    for level in levels:
+        if model == "closed":
+            # Users are kept between levels so each only signs up once
+            needed = int(level) - len(clients)
+            if needed > 0:
+                clients.extend(make_clients(needed, options))
+            options["recorder"].start(options["ramp"], options["duration"])
+            closed_loop(clients[:int(level)], options["duration"], options)
+        else:
+            if not clients:
+                clients = make_clients(options["accounts"], options)
+            options["recorder"].start(options["ramp"], options["duration"])
+            open_loop(clients, level, options["duration"], options)
+
+        report(model, level, options)
+
+    if options["csv"]:
+        fields = ["model", "level", "route", "journeys_per_second",
+                  "requests", "rps", "p50_ms", "p95_ms", "p99_ms",
+                  "error_pct", "shed_pct", "dropped", "wire_kb",
+                  "compression"]
+        with open(options["csv"], "w", newline="") as csv_file:
+            writer = csv.DictWriter(csv_file, fields)
+            writer.writeheader()
+            writer.writerows(options["rows"])
+
+
+@click.group()
+@click.option("--url", default="http://127.0.0.1:5000", show_default=True)
+@click.option("--duration", default=30.0, show_default=True,
+              help="Seconds each level runs for.")
+@click.option("--ramp", default=5.0, show_default=True,
+              help="Seconds at the start of each level left out.")
+@click.option("--signed-in", default=0.5, show_default=True,
+              help="Share of users with an account.")
+@click.option("--creators", default=0.05, show_default=True,
+              help="Share of signed in journeys that add a cocktail.")
+@click.option("--list-pages", default=0.2, show_default=True,
+              help="Chance a reader also opens view all or search.")
+@click.option("--encoding", default="gzip", show_default=True,
+              type=click.Choice(["identity", "gzip", "br"]),
+              help="Accept-Encoding sent, for comparing bytes on the wire.")
+@click.option("--timeout", default=30.0, show_default=True)
+@click.option("--csv", "csv_path", type=click.Path(dir_okay=False),
+              help="Write every level and route to a CSV file.")
+@click.option("--seed", type=int, help="Repeat the same random choices.")
+@click.pass_context
+def cli(context, url, duration, ramp, signed_in, creators, list_pages,
+        encoding, timeout, csv_path, seed):
+    if encoding == "br" and brotli is None:
+        raise click.ClickException("Install Brotli to request br")
+    if ramp >= duration:
+        raise click.ClickException("--ramp must be shorter than --duration")
+    if seed is not None:
+        random.seed(seed)
+
+    context.obj = {
+        "url": url,
+        "duration": duration,
+        "ramp": ramp,
+        "signed_in": signed_in,
+        "creators": creators,
+        "list_pages": list_pages,
+        "encoding": encoding,
+        "timeout": timeout,
+        "csv": csv_path,
+        "recorder": Recorder(),
+        "rows": [],
+    }
+
+
+@cli.command()
+@click.option("--users", default="1,2,4,8,16,32", show_default=True,
+              help="Comma separated numbers of users, one level each.")
+@click.option("--think-ms", default=1000.0, show_default=True,
+              help="Mean pause between a user's journeys.")
+@click.pass_obj
+def closed(options, users, think_ms):
+    """A fixed number of users each running journeys in turn"""
+    options["think_ms"] = think_ms
+    run_levels("closed", parse_levels(users), options)
+
+
+@cli.command("open")
+@click.option("--rates", default="1,2,4,8,16", show_default=True,
+              help="Comma separated journeys per second, one level each.")
+@click.option("--accounts", default=20, show_default=True,
+              help="Browsers the journeys are shared between.")
+@click.option("--max-inflight", default=500, show_default=True,
+              help="Journeys running at once before new ones are dropped.")
+@click.pass_obj
+def open_command(options, rates, accounts, max_inflight):
+    """Journeys arriving at a Poisson rate"""
+    options["accounts"] = accounts
+    options["max_inflight"] = max_inflight
+    run_levels("open", parse_levels(rates), options)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,16 @@
+import os
+import sys
+
+# app.py reads its settings when it is imported. No database is
+# needed, so it points at one that fails fast and the background
+# threads that would use it are left off.
+os.environ.setdefault(
+    "MONGO_URI",
+    "mongodb://127.0.0.1:9/mixology-test?serverSelectionTimeoutMS=50")
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("CACHE_BUS_ENABLED", "false")
+os.environ.setdefault("JOB_RUNNER_ENABLED", "false")
+os.environ.setdefault("WARMUP_ENABLED", "false")
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
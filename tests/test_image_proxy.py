@@ -0,0 +1,153 @@
+import io
+import ipaddress
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import app as mixology
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def make_png():
+    output = io.BytesIO()
+    Image.new("RGB", (800, 600), (200, 40, 40)).save(output, "PNG")
+    return output.getvalue()
+
+
+class Origin(BaseHTTPRequestHandler):
+    """Stand in for the site an image is linked from"""
+    png = make_png()
+    requests = []
+
+    def do_GET(self):
+        Origin.requests.append((self.path, self.headers["Host"]))
+        if self.path.startswith("/redirect/"):
+            self.send_response(302)
+            self.send_header("Location", self.path[len("/redirect/"):])
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(self.png)))
+        self.end_headers()
+        self.wfile.write(self.png)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def origin():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Origin)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_port
+    server.shutdown()
+
+
+@pytest.fixture
+def client(origin, tmp_path, monkeypatch):
+    """127.0.0.1 counts as public for these tests, and the made up
+    public.test resolves there once then rebinds to 127.0.0.2, which
+    stays private, so the fetch only works if it is pinned.
+    """
+    Origin.requests.clear()
+    monkeypatch.setitem(
+        mixology.app.config, "IMAGE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setitem(
+        mixology.app.config, "IMAGE_PROXY_ALLOW_PRIVATE", False)
+    monkeypatch.setattr(mixology, "image_cache", {
+        "bytes": None, "hits": 0, "misses": 0, "evicted": 0})
+    monkeypatch.setattr(
+        ipaddress.IPv4Address, "is_global",
+        property(lambda address: str(address) == "127.0.0.1"))
+
+    # The menus on the 404 page come from the database
+    monkeypatch.setattr(mixology, "get_reference", lambda collection: [])
+
+    lookups = []
+    getaddrinfo = socket.getaddrinfo
+
+    def rebinding_getaddrinfo(host, *args, **kwargs):
+        if host != "public.test":
+            return getaddrinfo(host, *args, **kwargs)
+        lookups.append(host)
+        address = "127.0.0.1" if len(lookups) == 1 else "127.0.0.2"
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, 0))]
+
+    monkeypatch.setattr(socket, "getaddrinfo", rebinding_getaddrinfo)
+    return mixology.app.test_client()
+
+
+def proxy_url(url, width=320):
+    with mixology.app.test_request_context():
+        return mixology.thumb(url, width)
+
+
+def test_miss_then_hit(origin, client):
+    url = proxy_url(f"http://public.test:{origin}/a.png")
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert mixology.image_cache["misses"] == 1
+    assert Origin.requests == [("/a.png", f"public.test:{origin}")]
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert mixology.image_cache["hits"] == 1
+    assert len(Origin.requests) == 1
+
+
+def test_webp_for_browsers_that_accept_it(origin, client):
+    url = proxy_url(f"http://public.test:{origin}/b.png")
+
+    webp = client.get(url, headers={"Accept": "image/webp,*/*"})
+    assert webp.mimetype == "image/webp"
+    assert Image.open(io.BytesIO(webp.data)).format == "WEBP"
+
+    jpeg = client.get(url, headers={"Accept": "image/png,*/*"})
+    assert jpeg.mimetype == "image/jpeg"
+    assert Image.open(io.BytesIO(jpeg.data)).size == (320, 240)
+    assert jpeg.headers["Vary"] == "Accept"
+
+    # The second format is made from the cached source
+    assert len(Origin.requests) == 1
+
+
+def test_unknown_width_is_not_found(origin, client):
+    url = proxy_url(f"http://public.test:{origin}/c.png")
+
+    response = client.get(url.replace("/320/", "/321/"))
+    assert response.status_code == 404
+    assert "Location" not in response.headers
+    assert Origin.requests == []
+
+
+def test_bad_token_is_not_found(client):
+    assert client.get("/img/320/not-a-token").status_code == 404
+
+
+def test_private_address_is_refused(origin, client):
+    url = f"http://127.0.0.2:{origin}/d.png"
+    with pytest.raises(ValueError):
+        mixology.fetch_image_source(url)
+
+    # The browser is sent to the original rather than the proxy
+    # fetching it
+    response = client.get(proxy_url(url))
+    assert response.status_code == 302
+    assert response.headers["Location"] == url
+    assert Origin.requests == []
+
+
+def test_private_redirect_is_refused(origin, client):
+    target = f"http://127.0.0.2:{origin}/e.png"
+    url = f"http://127.0.0.1:{origin}/redirect/{target}"
+    with pytest.raises(ValueError):
+        mixology.fetch_image_source(url)
+
+    assert Origin.requests == [(f"/redirect/{target}", f"127.0.0.1:{origin}")]
+